@@ -0,0 +1,315 @@
+"""
+A local stand-in for the Intuit v3 and appcenter endpoints, for benchmarks.
+
+It serves query (including count(*) and STARTPOSITION/MAXRESULTS paging), read,
+create/update/delete, batch and cdc under /v3, and the app menu, disconnect and
+reconnect under /api/v1. Entities are generated on the fly, so any realm holds
+`entity_count` entities of every type.
+
+Updates must carry the entity's current SyncToken (a stale one gets a 5010 fault),
+and a POST repeating a requestid gets the original response back.
+
+Latency, throttling (HTTP 429 with a ThrottleExceeded fault) and server errors
+(HTTP 500 with a SystemFault) can be injected:
+
+    server = FakeIntuitServer(latency=0.05, throttle_rate=0.01).start()
+    QUICKBOOKS['V3_URL_BASE'] = server.v3_url_base
+    QUICKBOOKS['APPCENTER_URL_BASE'] = server.appcenter_url_base
+    ...
+    server.stop()
+"""
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+# Create/update/delete URLs are lowercased by QuickbooksApi; this recovers the type name.
+OBJECT_TYPES = dict((name.lower(), name) for name in (
+    'Account', 'Bill', 'Customer', 'Employee', 'Estimate', 'Invoice', 'Item', 'JournalEntry', 'Payment',
+    'Purchase', 'SalesReceipt', 'TaxCode', 'Term', 'Vendor'))
+
+SELECT_RE = re.compile(r'select\s+(.+?)\s+from\s+(\w+)', re.IGNORECASE)
+PAGING_RE = re.compile(r'startposition\s+(\d+)\s+maxresults\s+(\d+)', re.IGNORECASE)
+ID_RE = re.compile(r"\bId\s*=\s*'([^']*)'", re.IGNORECASE)
+ID_IN_RE = re.compile(r"\bId\s+IN\s*\(([^)]*)\)", re.IGNORECASE)
+
+APP_MENU_HTML = '<div class="intuitPlatformAppMenu"><a href="#">Fake Intuit App Menu</a></div>'
+APPCENTER_RESPONSE = ('<?xml version="1.0" encoding="utf-8"?><{0} xmlns="http://platform.intuit.com/api/v1">'
+                      '<ErrorMessage/><ErrorCode>0</ErrorCode><ServerTime>{1}</ServerTime>{2}</{0}>')
+
+
+class FakeIntuitServer(object):
+    def __init__(self, latency=0.0, throttle_rate=0.0, error_rate=0.0, entity_count=5000, lines_per_entity=5,
+                 port=0, seed=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.entity_count = entity_count
+        self.lines_per_entity = lines_per_entity
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._next_id = entity_count + 1
+        self._sync_tokens = {}
+        self._responses = {}
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self.httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    @property
+    def v3_url_base(self):
+        return self.url + '/v3'
+
+    @property
+    def appcenter_url_base(self):
+        return self.url + '/api/v1/'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def entity(self, object_type, entity_id, sync_token=None):
+        entity_id = int(entity_id)
+        if sync_token is None:
+            sync_token = self._sync_tokens.get((object_type, str(entity_id)), 0)
+        entity = {
+            'Id': str(entity_id),
+            'SyncToken': str(sync_token),
+            'domain': 'QBO',
+            'sparse': False,
+            'MetaData': {'CreateTime': '2014-01-01T00:00:00-08:00',
+                         'LastUpdatedTime': '2014-06-01T00:00:00-08:00'},
+        }
+        if object_type in ('Invoice', 'Bill', 'Payment', 'Estimate', 'SalesReceipt'):
+            amount = round(10 + entity_id % 997 * 1.25, 2)
+            entity.update({
+                'DocNumber': str(1000 + entity_id),
+                'TxnDate': '2014-05-{:02d}'.format(entity_id % 28 + 1),
+                'TotalAmt': amount * self.lines_per_entity,
+                'Balance': 0,
+                'CustomerRef': {'value': str(entity_id % 50 + 1), 'name': 'Customer {}'.format(entity_id % 50 + 1)},
+                'CurrencyRef': {'value': 'USD', 'name': 'United States Dollar'},
+                'Line': [{'Id': str(line), 'LineNum': line, 'Amount': amount, 'DetailType': 'SalesItemLineDetail',
+                          'Description': 'Line {} of {} {}'.format(line, object_type, entity_id),
+                          'SalesItemLineDetail': {'ItemRef': {'value': str(line), 'name': 'Item {}'.format(line)},
+                                                  'UnitPrice': amount, 'Qty': 1,
+                                                  'TaxCodeRef': {'value': 'NON'}}}
+                         for line in range(1, self.lines_per_entity + 1)],
+            })
+        else:
+            entity.update({
+                'Name': '{} {}'.format(object_type, entity_id),
+                'DisplayName': '{} {}'.format(object_type, entity_id),
+                'FullyQualifiedName': '{} {}'.format(object_type, entity_id),
+                'Active': True,
+            })
+        return entity
+
+    def new_id(self):
+        with self._lock:
+            self._next_id += 1
+            return str(self._next_id)
+
+    def fault(self):
+        """ Returns an injected (status, body) failure for this request, or None. """
+        with self._lock:
+            self.requests += 1
+            roll = self.random.random()
+        if roll < self.throttle_rate:
+            return 429, {'Fault': {'type': 'ThrottleExceeded', 'Error': [
+                {'Message': 'message=ThrottleExceeded; errorCode=003001', 'code': '3001'}]}}
+        if roll < self.throttle_rate + self.error_rate:
+            return 500, {'Fault': {'type': 'SystemFault', 'Error': [
+                {'Message': 'An application error has occurred while processing your request',
+                 'code': '10000'}]}}
+        return None
+
+    def query(self, query):
+        match = SELECT_RE.search(query)
+        if match is None:
+            return 400, {'Fault': {'type': 'ValidationFault', 'Error': [
+                {'Message': 'Error parsing query', 'code': '4000'}]}}
+        selection, object_type = match.groups()
+        if selection.strip().lower() == 'count(*)':
+            return 200, {'QueryResponse': {'totalCount': self.entity_count}, 'time': _now()}
+
+        id_match = ID_RE.search(query)
+        id_in_match = ID_IN_RE.search(query)
+        if id_match or id_in_match:
+            requested = [id_match.group(1)] if id_match else re.findall(r"'([^']*)'", id_in_match.group(1))
+            ids = [int(entity_id) for entity_id in requested if 0 < int(entity_id) <= self.entity_count]
+        else:
+            paging = PAGING_RE.search(query)
+            start, count = (int(paging.group(1)), int(paging.group(2))) if paging else (1, 100)
+            ids = range(start, min(start + count, self.entity_count + 1))
+
+        entities = [self.entity(object_type, entity_id) for entity_id in ids]
+        response = {'startPosition': ids[0] if entities else 1, 'maxResults': len(entities)}
+        if entities:
+            response[object_type] = entities
+        return 200, {'QueryResponse': response, 'time': _now()}
+
+    def write(self, object_type, operation, body):
+        """ Returns (entity, fault); exactly one of them is None. """
+        entity = dict(body)
+        if operation == 'create':
+            entity['Id'] = self.new_id()
+            entity['SyncToken'] = '0'
+        elif operation == 'delete':
+            entity = {'Id': body.get('Id'), 'status': 'Deleted', 'domain': 'QBO'}
+        else:
+            key = (object_type, str(body.get('Id')))
+            with self._lock:
+                current = self._sync_tokens.get(key, 0)
+                if str(body.get('SyncToken')) != str(current):
+                    return None, {'type': 'ValidationFault', 'Error': [
+                        {'Message': 'Stale Object Error', 'code': '5010',
+                         'Detail': 'You and someone else were working on this at the same time.'}]}
+                self._sync_tokens[key] = current + 1
+            if body.get('sparse'):
+                entity = dict(self.entity(object_type, key[1]), **body)
+            entity['SyncToken'] = str(current + 1)
+        return entity, None
+
+    def replay(self, request_id, respond):
+        """ Returns the response stored for `request_id`, or respond()'s, which is then stored. """
+        if not request_id:
+            return respond()
+        with self._lock:
+            if request_id in self._responses:
+                return self._responses[request_id]
+        response = self._responses[request_id] = respond()
+        return response
+
+    def batch(self, items):
+        responses = []
+        for item in items:
+            if 'Query' in item:
+                status, body = self.query(item['Query'])
+                body.pop('time', None)
+                body['bId'] = item['bId']
+                responses.append(body)
+                continue
+            operation = item.get('operation')
+            object_type = [key for key in item if key not in ('bId', 'operation', 'optionsData')][0]
+            entity, fault = self.write(object_type, operation, item[object_type])
+            responses.append({'bId': item['bId'], 'Fault': fault} if fault else {'bId': item['bId'], object_type: entity})
+        return {'BatchItemResponse': responses, 'time': _now()}
+
+    def cdc(self, entity_types):
+        query_responses = []
+        for object_type in entity_types:
+            changed = [self.entity(object_type, entity_id, sync_token=1) for entity_id in range(1, 6)]
+            changed.append({'Id': str(self.entity_count), 'status': 'Deleted', 'domain': 'QBO'})
+            query_responses.append({object_type: changed, 'startPosition': 1, 'maxResults': len(changed)})
+        return {'CDCResponse': [{'QueryResponse': query_responses}], 'time': _now()}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, so connection reuse shows up in the benchmarks. Responses are written in one
+    # go with Nagle off; otherwise delayed ACKs add ~40ms to every reused connection.
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        fake = self.server.fake
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        url = urlparse(self.path)
+        params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        parts = [part for part in url.path.split('/') if part]
+
+        if parts[:2] == ['api', 'v1']:
+            return self._appcenter(parts[2:])
+
+        failure = fake.fault()
+        if failure is not None:
+            return self._send_json(*failure)
+
+        # /v3/company/<realm>/<resource>[/<id>]
+        resource = parts[3] if len(parts) > 3 else ''
+        if method == 'GET' and resource == 'query':
+            return self._send_json(*fake.query(params.get('query', '')))
+        if method == 'GET' and resource == 'cdc':
+            return self._send_json(200, fake.cdc(params.get('entities', '').split(',')))
+        if method == 'POST' and resource == 'batch':
+            items = json.loads(body.decode('utf-8'))['BatchItemRequest']
+            return self._send_json(*fake.replay(params.get('requestid'), lambda: (200, fake.batch(items))))
+        if method == 'GET' and len(parts) == 5:
+            return self._send_json(200, {resource: fake.entity(resource, parts[4]), 'time': _now()})
+        if method == 'POST' and len(parts) == 4:
+            object_type = OBJECT_TYPES.get(resource, resource.capitalize())
+            return self._send_json(*fake.replay(params.get('requestid'), lambda: self._write(
+                object_type, params.get('operation', 'create'), json.loads(body.decode('utf-8')))))
+        self._send_json(404, {'Fault': {'type': 'SystemFault', 'Error': [{'Message': 'Not found', 'code': '404'}]}})
+
+    def _write(self, object_type, operation, body):
+        entity, fault = self.server.fake.write(object_type, operation, body)
+        if fault:
+            return 400, {'Fault': fault, 'time': _now()}
+        return 200, {object_type: entity, 'time': _now()}
+
+    def _appcenter(self, parts):
+        path = '/'.join(parts)
+        if path == 'account/appmenu':
+            return self._send(200, APP_MENU_HTML, 'text/html')
+        if path == 'connection/disconnect':
+            return self._send(200, APPCENTER_RESPONSE.format('PlatformResponse', _now(), ''), 'text/xml')
+        if path == 'connection/reconnect':
+            tokens = '<OAuthToken>fake-token-{0}</OAuthToken><OAuthTokenSecret>fake-secret-{0}</OAuthTokenSecret>'
+            return self._send(200, APPCENTER_RESPONSE.format('ReconnectResponse', _now(),
+                                                             tokens.format(self.server.fake.new_id())), 'text/xml')
+        self._send(404, 'Not found', 'text/plain')
+
+    def _send_json(self, status, body):
+        self._send(status, json.dumps(body), 'application/json')
+
+    def _send(self, status, body, content_type):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S-00:00', time.gmtime())
@@ -0,0 +1,200 @@
+"""
+Benchmarks for QuickbooksApi against the local fake Intuit server.
+
+    python benchmarks/run.py [--latency 0.02] [--requests 500] [--concurrency 20]
+                             [--throttle-rate 0] [--error-rate 0] [--entities 20000]
+
+Measures throughput, p50/p99 latency, retries and errors for unpooled and pooled sessions, the
+AsyncQuickbooksApi, single creates versus batch creates, and peak memory while
+walking a large paginated query. Everything runs in this process against
+benchmarks/fake_intuit.py; no database or Intuit account is needed. Run it from the
+repository root with the requirements installed.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_intuit import FakeIntuitServer  # noqa
+
+
+def configure(server, keys_dir):
+    from django.conf import settings
+    from keyczar import keyczart
+
+    keyczart.main(['create', '--location=' + keys_dir, '--purpose=crypt'])
+    keyczart.main(['addkey', '--location=' + keys_dir, '--status=primary'])
+    settings.configure(
+        INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes', 'quickbooks'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        ENCRYPTED_FIELD_KEYS_DIR=keys_dir,
+        QUICKBOOKS={
+            'CONSUMER_KEY': 'benchmark-key',
+            'CONSUMER_SECRET': 'benchmark-secret',
+            'V3_URL_BASE': server.v3_url_base,
+            'APPCENTER_URL_BASE': server.appcenter_url_base,
+            'REQUESTS_PER_MINUTE': 10 ** 6,
+            'BACKOFF_BASE': 0.01,
+            'BACKOFF_MAX': 0.1,
+        },
+    )
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def make_token(realm_id='1000'):
+    from quickbooks.models import QuickbooksToken
+    return QuickbooksToken(user_id=1, access_token='token', access_token_secret='secret',
+                           realm_id=realm_id, data_source='QBO')
+
+
+def timed(name, operations, sink, fn, **filters):
+    """ Runs fn, then reports throughput and the per-request latency recorded by the sink. """
+    sink.clear()
+    started = time.time()
+    fn()
+    elapsed = time.time() - started
+    p50 = sink.percentile(50, **filters)
+    p99 = sink.percentile(99, **filters)
+    print('{:<28} {:>8.1f} ops/s {:>9} {:>9} {:>8} {:>8} {:>8}'.format(
+        name, operations / elapsed, _ms(p50), _ms(p99), len(sink.values(**filters)),
+        sum(sink.values('retries', **filters)), len([error for error in sink.values('error', **filters) if error])))
+
+
+def bench_unpooled(count):
+    from quickbooks.api import QuickbooksApi
+    from quickbooks.sessions import session_pool
+
+    token = make_token()
+    for entity_id in range(1, count + 1):
+        # What every QuickbooksApi used to do: a brand new session (and connection) each time.
+        session_pool.clear()
+        _ignore_errors(QuickbooksApi(token).read, 'Customer', entity_id)
+
+
+def bench_pooled(count):
+    from quickbooks.api import QuickbooksApi
+
+    token = make_token()
+    for entity_id in range(1, count + 1):
+        _ignore_errors(QuickbooksApi(token).read, 'Customer', entity_id)
+
+
+def bench_async(count, concurrency):
+    from concurrent.futures import wait
+    from quickbooks.async_api import AsyncQuickbooksApi
+
+    # Spread the calls over several realms so the per-realm limit is not the bottleneck.
+    apis = [AsyncQuickbooksApi(make_token(str(2000 + realm))) for realm in range(max(1, concurrency // 10))]
+    futures = [apis[entity_id % len(apis)].read('Customer', entity_id) for entity_id in range(1, count + 1)]
+    wait(futures)
+
+
+def bench_creates(count):
+    from quickbooks.api import QuickbooksApi
+
+    api = QuickbooksApi(make_token())
+    for number in range(count):
+        _ignore_errors(api.create, 'Customer', {'DisplayName': 'Customer {}'.format(number)})
+
+
+def bench_batch(count):
+    from quickbooks.api import QuickbooksApi
+
+    api = QuickbooksApi(make_token())
+    _ignore_errors(api.batch, [('create', 'Customer', {'DisplayName': 'Customer {}'.format(number)})
+                               for number in range(count)])
+
+
+def _walk_query(mode, queue):
+    from quickbooks.api import QuickbooksApi
+
+    api = QuickbooksApi(make_token())
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.time()
+    if mode == 'list':
+        rows = []
+        for page in api.query_pages('select * from Invoice'):
+            rows.extend(page)
+        count = len(rows)
+    else:
+        count = sum(1 for _ in api.query_iter('select * from Invoice', prefetch=mode != 'stream',
+                                              typed=mode == 'typed', stream=mode == 'stream'))
+    elapsed = time.time() - started
+    queue.put((count, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before))
+
+
+def bench_query_memory(mode):
+    """ Walks every Invoice in a child process, so each mode gets its own peak RSS. """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_walk_query, args=(mode, queue))
+    process.start()
+    count, elapsed, peak = queue.get()
+    process.join()
+    # ru_maxrss is in kilobytes on Linux and bytes on OS X.
+    peak_mb = peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+    print('{:<28} {:>8.1f} ops/s {:>8} rows {:>8.1f} MB peak'.format(
+        'query ' + mode, count / elapsed, count, peak_mb))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds the fake server waits per request.')
+    parser.add_argument('--requests', type=int, default=300, help='Requests per benchmark.')
+    parser.add_argument('--concurrency', type=int, default=20, help='Worker threads for the async benchmark.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests throttled.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests failing with a 500.')
+    parser.add_argument('--entities', type=int, default=20000, help='Entities per type on the fake server.')
+    args = parser.parse_args()
+
+    server = FakeIntuitServer(latency=args.latency, throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                              entity_count=args.entities, seed=1).start()
+    keys_dir = tempfile.mkdtemp()
+    try:
+        configure(server, keys_dir)
+        from django.conf import settings
+        from quickbooks import instrumentation
+
+        settings.QUICKBOOKS['ASYNC_MAX_WORKERS'] = args.concurrency
+        sink = instrumentation.MemorySink()
+        instrumentation.add_sink(sink)
+
+        print('{:<28} {:>14} {:>9} {:>9} {:>8} {:>8} {:>8}'.format(
+            'benchmark', 'throughput', 'p50', 'p99', 'requests', 'retries', 'errors'))
+        timed('read, new session per call', args.requests, sink, lambda: bench_unpooled(args.requests))
+        timed('read, pooled session', args.requests, sink, lambda: bench_pooled(args.requests))
+        timed('read, async', args.requests, sink, lambda: bench_async(args.requests, args.concurrency))
+        timed('create, one per request', args.requests, sink, lambda: bench_creates(args.requests))
+        timed('create, batch', args.requests, sink, lambda: bench_batch(args.requests), operation='batch')
+        for mode in ('list', 'iter', 'typed', 'stream'):
+            bench_query_memory(mode)
+    finally:
+        from quickbooks.sessions import session_pool
+        session_pool.clear()
+        server.stop()
+        shutil.rmtree(keys_dir)
+
+
+def _ignore_errors(fn, *args):
+    """ Injected errors are counted from the metrics instead of stopping the benchmark. """
+    from quickbooks.api import QuickbooksError
+    try:
+        return fn(*args)
+    except QuickbooksError:
+        return None
+
+
+def _ms(seconds):
+    return '-' if seconds is None else '{:.1f}ms'.format(seconds * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,74 @@
+import datetime
+import json
+import re
+import threading
+import time
 import urllib
+from collections import namedtuple
 
-from requests_oauthlib import OAuth1Session
+import requests
 from django.conf import settings
 from django.contrib.auth.models import User
-from quickbooks.models import QuickbooksToken
+from quickbooks import entities, instrumentation, streaming
+from quickbooks.models import MissingTokenException, QuickbooksToken, token_for_user, touch_token
+from quickbooks.query import QuerySet, format_timestamp
+from quickbooks.sessions import session_pool
+from quickbooks.signals import qb_pre_request
+from quickbooks.throttle import backoff_delay, get_realm_throttle
 
 APPCENTER_URL_BASE = 'https://appcenter.intuit.com/api/v1/'
 
 QUICKBOOKS_DESKTOP_V3_URL_BASE = 'https://quickbooks.api.intuit.com/v3'
 QUICKBOOKS_ONLINE_V3_URL_BASE = 'https://quickbooks.api.intuit.com/v3'
 
+# QBO refuses to return more than 1000 rows for a single query.
+MAX_QUERY_PAGE_SIZE = 1000
+
+# The batch endpoint accepts at most 30 operations per request.
+MAX_BATCH_SIZE = 30
+
+BATCH_OPERATIONS = ('create', 'update', 'delete', 'read', 'query')
+
+# Bytes read at a time when a query response is streamed.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+PAGING_CLAUSE_RE = re.compile(r'\b(STARTPOSITION|MAXRESULTS)\b', re.IGNORECASE)
+QUERY_OBJECT_TYPE_RE = re.compile(r'\bfrom\s+(\w+)', re.IGNORECASE)
+
+# ChangeDataCapture only looks back this far.
+CDC_MAX_AGE = datetime.timedelta(days=30)
+
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_TIMEOUT = 60
+
+# HTTP statuses raised as TryLaterError. 429 and 503 mean Intuit turned the request away, so
+# it can always be sent again. 502 and 504 come from a gateway that may already have passed it
+# on, so only idempotent requests are retried after them.
+TRY_LATER_STATUSES = (429, 502, 503, 504)
+GATEWAY_ERROR_STATUSES = (502, 504)
+
+# Fault error codes, see
+# https://developer.intuit.com/docs/0025_quickbooksapi/0050_data_services/020_key_concepts/error_handling
+THROTTLE_FAULT_CODES = ('3001', '3002')
+AUTHENTICATION_FAULT_CODES = ('100', '3100', '3200')
+DUPLICATE_FAULT_CODES = ('6240',)
+STALE_OBJECT_FAULT_CODES = ('5010',)
+
+# Appcenter replies with an ErrorCode element; these mean the OAuth token is no good.
+APPCENTER_ERROR_CODE_RE = re.compile(r'<ErrorCode>\s*(\d+)\s*</ErrorCode>')
+APPCENTER_ERROR_MESSAGE_RE = re.compile(r'<ErrorMessage>([^<]*)</ErrorMessage>')
+APPCENTER_AUTHENTICATION_ERROR_CODES = ('22', '24', '270')
+# Reconnect is only allowed in the 30 days before the token expires; outside them it answers 212.
+APPCENTER_RECONNECT_WINDOW_ERROR_CODE = '212'
+APPCENTER_OAUTH_TOKEN_RE = re.compile(r'<OAuthToken>\s*([^<]+?)\s*</OAuthToken>')
+APPCENTER_OAUTH_TOKEN_SECRET_RE = re.compile(r'<OAuthTokenSecret>\s*([^<]+?)\s*</OAuthTokenSecret>')
+
 
 class QuickbooksError(Exception):
-    pass
+    def __init__(self, message=None, fault=None, response=None):
+        super(QuickbooksError, self).__init__(message)
+        self.fault = fault
+        self.response = response
 
 
 class TryLaterError(QuickbooksError):
@@ -35,55 +91,147 @@ class DuplicateItemError(ApiError):
     pass
 
 
+class StaleObjectError(ApiError):
+    """ The SyncToken sent with an update is out of date; re-read the entity and try again. """
+    pass
+
+
+class BatchResult(namedtuple('BatchResult', 'operation object_type entity fault')):
+    """ The outcome of one batch operation. `entity` holds the returned entity (or the entity
+        list for read/query operations), `fault` the Fault payload if the operation failed.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.fault is None
+
+
 class QuickbooksApi(object):
     """ This is an interface to the QBD and QBO v3 api."""
-    def __init__(self, owner_or_token):
+    def __init__(self, owner_or_token, cache=None):
+        """ `cache` turns on read-through caching of read/query results: pass True for an
+            EntityCache configured from settings, or an EntityCache instance.
+        """
         if isinstance(owner_or_token, User):
-            self.token = QuickbooksToken.objects.filter(user=owner_or_token).first()
+            self.token = token_for_user(owner_or_token)
+            if self.token is None:
+                raise MissingTokenException("No QuickBooks OAuth token exists for this user")
         elif isinstance(owner_or_token, QuickbooksToken):
             self.token = owner_or_token
         else:
             raise ValueError("API must be initialized with either a QuickbooksToken or User")
 
-        session = OAuth1Session(client_key=settings.QUICKBOOKS['CONSUMER_KEY'],
-                                client_secret=settings.QUICKBOOKS['CONSUMER_SECRET'],
-                                resource_owner_key=self.token.access_token,
-                                resource_owner_secret=self.token.access_token_secret)
-
-        session.headers.update({'content-type': 'application/json', 'accept': 'application/json'})
-        self.session = session
+        touch_token(self.token)
+        self.session = session_pool.get(self.token)
         self.realm_id = self.token.realm_id
         self.data_source = self.token.data_source
-        self.url_base = {'QBD': QUICKBOOKS_DESKTOP_V3_URL_BASE,
-                         'QBO': QUICKBOOKS_ONLINE_V3_URL_BASE}[self.token.data_source]
-
-    def _appcenter_request(self, url, retries=3):
-        full_url = APPCENTER_URL_BASE + url
-
-        for retry_i in range(retries + 1):
-            content = self.session.get(full_url).content
+        self.url_base = settings.QUICKBOOKS.get('V3_URL_BASE') or \
+            {'QBD': QUICKBOOKS_DESKTOP_V3_URL_BASE,
+             'QBO': QUICKBOOKS_ONLINE_V3_URL_BASE}[self.token.data_source]
+
+        if cache is True:
+            from quickbooks.cache import EntityCache
+            cache = EntityCache(self.realm_id)
+        self.cache = cache or None
+
+    def _request(self, method, url, data=None, idempotent=None, retries=None, operation=None, object_type=None,
+                 stream=False):
+        """ Sends a request through the realm's throttle and returns the response.
+
+            Throttle faults and unavailable servers (TryLaterError) are retried with exponential
+            backoff, as are gateway errors and network failures (CommunicationError) for
+            idempotent requests; GETs are idempotent unless told otherwise. Anything else that
+            is not a success is raised as the matching QuickbooksError.
+
+            `operation` and `object_type` label the RequestMetric recorded for the call. With
+            `stream` the body of a successful response is left unread; the caller must read or
+            close it.
+        """
+        if idempotent is None:
+            idempotent = method == 'GET'
+        if retries is None:
+            retries = settings.QUICKBOOKS.get('MAX_RETRIES', DEFAULT_MAX_RETRIES)
+        timeout = settings.QUICKBOOKS.get('TIMEOUT', DEFAULT_TIMEOUT)
+        throttle = get_realm_throttle(self.realm_id)
+
+        instrumentation.send_signal(qb_pre_request, realm_id=self.realm_id, method=method, url=url,
+                                    operation=operation, object_type=object_type)
+        started = time.time()
+        attempt = throttles = 0
+        throttle_wait = 0.0
+        response = error = None
+        try:
+            while True:
+                response = None
+                try:
+                    with throttle.slot() as waited:
+                        throttle_wait += waited
+                        response = self.session.request(method, url, data=data, timeout=timeout, stream=stream)
+                    error = response_error(response)
+                except requests.exceptions.RequestException as e:
+                    error = CommunicationError(str(e))
+
+                if error is None:
+                    return response
+                if not should_retry(error, idempotent) or attempt >= retries:
+                    raise error
+
+                delay = backoff_delay(attempt, _retry_after(response))
+                if isinstance(error, TryLaterError):
+                    # Hold back every caller for this realm, not just this one.
+                    throttle.pause(delay)
+                    throttles += 1
+                time.sleep(delay)
+                attempt += 1
+        finally:
+            instrumentation.record(instrumentation.RequestMetric(
+                operation=operation, object_type=object_type, realm_id=self.realm_id, method=method,
+                status=response.status_code if response is not None else None, latency=time.time() - started,
+                request_bytes=len(data) if data else 0,
+                response_bytes=_response_bytes(response, stream),
+                retries=attempt, throttles=throttles, throttle_wait=throttle_wait,
+                error=type(error).__name__ if error is not None else None))
+
+    def _appcenter_request(self, url, retries=3, operation=None, idempotent=None):
+        full_url = settings.QUICKBOOKS.get('APPCENTER_URL_BASE', APPCENTER_URL_BASE) + url
+        return self._request('GET', full_url, retries=retries, operation=operation, idempotent=idempotent).content
 
-        # [todo] - Add some error handling for _appcenter_requests.
+    def app_menu(self, retries=3):
         # https://developer.intuit.com/docs/0025_quickbooksapi/0053_auth_auth/platform_api#AppMenu
-        # intuit's documentation is a bit vauge:
-        # "Note that this API returns HTML intended for display, not XML data."
         # "Status code 200 - The OAuth access token has expired or is invalid for some other reason. The HTML returned
         # shows the Connect to QuickBooks button within the Intuit Blue Dot menu. "
+        # So there is no error to detect here; the menu itself tells the user to reconnect.
+        return self._appcenter_request('account/appmenu', retries=retries, operation='app_menu')
 
+    def disconnect(self):
+        content = self._appcenter_request('connection/disconnect', operation='disconnect')
+        _raise_for_appcenter_error(content)
         return content
 
-    def app_menu(self, retries=3):
-        return self._appcenter_request('account/appmenu', retries=retries)
-
-    def disconnect(self):
-        return self._appcenter_request('connection/disconnect')
+    def reconnect(self):
+        """ Asks Intuit for a new access token to replace this one, and returns it as
+            (access_token, access_token_secret). The old token stops working straight away, so
+            the new one must be stored; quickbooks.health.reconnect_token does that.
 
-    def read(self, object_type, entity_id):
+            Intuit only allows this in the 30 days before the token expires; outside them an
+            ApiError with fault code APPCENTER_RECONNECT_WINDOW_ERROR_CODE is raised.
+        """
+        # A lost response would lose the new token too, so network failures aren't retried.
+        content = self._appcenter_request('connection/reconnect', operation='reconnect', idempotent=False)
+        _raise_for_appcenter_error(content)
+        access_token = APPCENTER_OAUTH_TOKEN_RE.search(content)
+        access_token_secret = APPCENTER_OAUTH_TOKEN_SECRET_RE.search(content)
+        if access_token is None or access_token_secret is None:
+            raise ApiError("Appcenter reconnect response had no OAuth token")
+        return access_token.group(1), access_token_secret.group(1)
+
+    def read(self, object_type, entity_id, typed=False):
         """ Make a call to /company/<token_realm_id>/<object_type>/<entity_id>
             This will return the details for the entity id in the
 
+            With `typed` the entity itself is returned, wrapped by quickbooks.entities.load.
         """
-        # [todo] - add error handling for v3 read
         """ Example Error:
         {u'Fault': {u'Error': [{u'Detail': u'System Failure Error: Could not find resource for relative :
         /v3/company/<id>/Employee/0 of full path: https://internal.qbo.intuit.com/qbo30/v3/company/<id>/Employee/0',
@@ -93,8 +241,18 @@ class QuickbooksApi(object):
          u'time': u'<Timestamp>'
          }
          """
+        if self.cache is not None:
+            entity = self.cache.get(object_type, entity_id)
+            if entity is not None:
+                return entities.load(object_type, entity) if typed else {object_type: entity}
+
         constructed_url = "{}/company/{}/{}/{}".format(self.url_base, self.realm_id, object_type, entity_id)
-        return self.session.get(constructed_url).json()
+        response = self._request('GET', constructed_url, operation='read', object_type=object_type).json()
+        if self.cache is not None and object_type in response:
+            self.cache.set(object_type, response[object_type])
+        if typed:
+            return entities.load(object_type, response[object_type]) if object_type in response else None
+        return response
 
     def query(self, query):
         """
@@ -103,24 +261,404 @@ class QuickbooksApi(object):
 
             It is similar to SQL.
         """
-        # [todo] - add error handling for v3 query
-        constructed_url = "{}/company/{}/query?query={}".format(self.url_base, self.realm_id, urllib.quote(query))
-        return self.session.get(constructed_url).json()
+        object_type = query_object_type(query)
+        if self.cache is not None and object_type is not None:
+            response = self.cache.get_query(object_type, query)
+            if response is not None:
+                return response
+
+        response = self._request('GET', self._query_url(query), operation='query', object_type=object_type).json()
+        if self.cache is not None and object_type is not None:
+            self.cache.set_query(object_type, query, response)
+        return response
+
+    def cdc(self, entity_types, changed_since):
+        """ Make a call to /company/<token_realm_id>/cdc, which returns every entity of
+            `entity_types` that changed since `changed_since` (a datetime or an ISO 8601 string,
+            at most 30 days ago). Deleted entities come back with status 'Deleted'.
+            Use cdc_changes to pull the entities out of the response.
+        """
+        constructed_url = "{}/company/{}/cdc?entities={}&changedSince={}".format(
+            self.url_base, self.realm_id, urllib.quote(','.join(entity_types)),
+            urllib.quote(format_timestamp(changed_since)))
+        return self._request('GET', constructed_url, operation='cdc').json()
+
+    def refresh_from_cdc(self, entity_types=None):
+        """ Brings the cache up to date with whatever changed since the last call. """
+        if self.cache is None:
+            raise ValueError("refresh_from_cdc requires a QuickbooksApi with a cache")
+        return self.cache.refresh_from_cdc(self, entity_types)
+
+    def objects(self, object_type):
+        """ Returns a lazy QuerySet for `object_type`, e.g.
+            api.objects('Invoice').filter(TxnDate__gte=date(2014, 1, 1)).only('Id', 'TotalAmt')[:100]
+        """
+        return QuerySet(self, object_type)
+
+    def query_pages(self, query, page_size=MAX_QUERY_PAGE_SIZE, start_position=1, limit=None, prefetch=False):
+        """ Pages through the results of `query`, yielding one list of entities per page.
 
-    def create(self, object_type, object_body):
-        # [todo] - add error handling for v3 create
+            STARTPOSITION and MAXRESULTS are added by this method, so `query` must not contain them.
+            `limit` caps the total number of entities returned. With `prefetch` the next page is
+            requested in a background thread while the caller works on the current one.
+        """
+        _check_paged_query(query, page_size)
+        position = start_position
+        remaining = limit
+        pending = None
+
+        while remaining is None or remaining > 0:
+            max_results = page_size if remaining is None else min(page_size, remaining)
+            if pending is not None:
+                page = pending.result()
+            else:
+                page = self._query_page(query, position, max_results)
+            pending = None
+
+            # Stop on a short page: there is nothing left to fetch.
+            exhausted = len(page) < max_results
+            if remaining is not None:
+                remaining -= len(page)
+            position += len(page)
+
+            if prefetch and not exhausted and (remaining is None or remaining > 0):
+                next_size = page_size if remaining is None else min(page_size, remaining)
+                pending = _PageFetch(self._query_page, query, position, next_size)
+
+            if page:
+                yield page
+            if exhausted:
+                break
+
+    def query_iter(self, query, page_size=MAX_QUERY_PAGE_SIZE, start_position=1, limit=None, prefetch=False,
+                   typed=False, stream=False):
+        """ Like query_pages, but yields the entities one at a time. Only one page (two with
+            `prefetch`) is held in memory, so arbitrarily large result sets can be walked.
+            With `typed` the entities are wrapped by quickbooks.entities.load.
+
+            With `stream` each page is decoded as it is read from the network (see
+            quickbooks.streaming), so only one entity is held in memory at a time and the first
+            one arrives before the rest of the page. Streamed queries bypass the cache and can't
+            be combined with `prefetch`.
+        """
+        if stream and prefetch:
+            raise ValueError("query_iter can't prefetch pages while streaming them")
+        object_type = query_object_type(query)
+        if stream:
+            results = self._query_stream(query, page_size, start_position, limit)
+        else:
+            results = (entity for page in self.query_pages(query, page_size=page_size, start_position=start_position,
+                                                           limit=limit, prefetch=prefetch)
+                       for entity in page)
+        for entity in results:
+            yield entities.load(object_type, entity) if typed else entity
+
+    def _query_stream(self, query, page_size, start_position, limit):
+        """ The paging loop of query_pages, for streamed pages. """
+        _check_paged_query(query, page_size)
+        position = start_position
+        remaining = limit
+
+        while remaining is None or remaining > 0:
+            max_results = page_size if remaining is None else min(page_size, remaining)
+            count = 0
+            for entity in self._stream_query_page(query, position, max_results):
+                count += 1
+                yield entity
+            if remaining is not None:
+                remaining -= count
+            position += count
+            if count < max_results:
+                break
+
+    def batch(self, operations, request_id=None):
+        """ Runs a list of operations through /company/<token_realm_id>/batch, MAX_BATCH_SIZE at a
+            time, and returns one BatchResult per operation, in the order given.
+
+            Each operation is a tuple:
+                ('create', object_type, object_body)
+                ('update', object_type, object_body)
+                ('delete', object_type, object_body)
+                ('read', object_type, entity_id)
+                ('query', query)
+            Object bodies may be dicts, JSON strings or Entity instances. A failing operation does not stop the
+            others; check `result.ok` / `result.fault` for each one.
+
+            See create() for `request_id`; each MAX_BATCH_SIZE chunk gets its own, derived from it.
+        """
+        operations = list(operations)
+        results = []
+        for chunk_start in range(0, len(operations), MAX_BATCH_SIZE):
+            chunk = operations[chunk_start:chunk_start + MAX_BATCH_SIZE]
+            chunk_request_id = request_id
+            if request_id is not None and len(operations) > MAX_BATCH_SIZE:
+                chunk_request_id = "{}-{}".format(request_id, chunk_start // MAX_BATCH_SIZE)
+            results.extend(self._batch_chunk(chunk, chunk_request_id))
+        return results
+
+    def _batch_chunk(self, operations, request_id=None):
+        items = [_batch_item(str(bid), operation) for bid, operation in enumerate(operations)]
+        constructed_url = _with_request_id("{}/company/{}/batch".format(self.url_base, self.realm_id), request_id)
+        response = self._request('POST', constructed_url, data=json.dumps({'BatchItemRequest': items}),
+                                 idempotent=request_id is not None, operation='batch').json()
+
+        by_bid = dict((item['bId'], item) for item in response.get('BatchItemResponse', []))
+        results = []
+        for bid, operation in enumerate(operations):
+            kind = operation[0]
+            object_type = None if kind == 'query' else operation[1]
+            item = by_bid.get(str(bid))
+            if item is None:
+                fault = {'type': 'BatchItemMissing',
+                         'Error': [{'Message': 'No response was returned for this operation'}]}
+                results.append(BatchResult(kind, object_type, None, fault))
+            elif 'Fault' in item:
+                results.append(BatchResult(kind, object_type, None, item['Fault']))
+            elif kind in ('read', 'query'):
+                entities = query_response_entities(item)
+                if kind == 'read':
+                    entities = entities[0] if entities else None
+                results.append(BatchResult(kind, object_type, entities, None))
+            else:
+                self._cache_write(kind, object_type, item.get(object_type))
+                results.append(BatchResult(kind, object_type, item.get(object_type), None))
+        return results
+
+    def _query_page(self, query, start_position, max_results):
+        return query_response_entities(self.query(_paged_query(query, start_position, max_results)))
+
+    def _stream_query_page(self, query, start_position, max_results):
+        paged_query = _paged_query(query, start_position, max_results)
+        response = self._request('GET', self._query_url(paged_query), operation='query',
+                                 object_type=query_object_type(query), stream=True)
+        try:
+            for entity in streaming.iter_query_entities(response.iter_content(STREAM_CHUNK_SIZE), fault_error):
+                yield entity
+        except requests.exceptions.RequestException as e:
+            raise CommunicationError(str(e))
+        finally:
+            # Hands the connection back to the pool, even if the caller stops early.
+            response.close()
+
+    def _query_url(self, query):
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        return "{}/company/{}/query?query={}".format(self.url_base, self.realm_id, urllib.quote(query))
+
+    def create(self, object_type, object_body, request_id=None):
+        """ With a `request_id` (at most 50 characters, unique per write) Intuit answers a repeated
+            request with the original response instead of applying it twice, so the request is also
+            retried after network failures.
+        """
         # [todo] - validate that the object_body is a proper json blob
         constructed_url = "{}/company/{}/{}".format(self.url_base, self.realm_id, object_type)
-        return self.session.post(constructed_url.lower(), object_body).json()
+        response = self._request('POST', _with_request_id(constructed_url.lower(), request_id),
+                                 data=entities.dump(object_body), idempotent=request_id is not None,
+                                 operation='create', object_type=object_type).json()
+        self._cache_write('create', object_type, response.get(object_type))
+        return response
 
-    def delete(self, object_type, object_body):
-        # [todo] - add error handling for v3 delete
+    def delete(self, object_type, object_body, request_id=None):
         # [todo] - validate that the object_body is a proper json blob
         constructed_url = "{}/company/{}/{}?operation=delete".format(self.url_base, self.realm_id, object_type)
-        return self.session.post(constructed_url.lower(), object_body).json()
+        response = self._request('POST', _with_request_id(constructed_url.lower(), request_id),
+                                 data=entities.dump(object_body), idempotent=request_id is not None,
+                                 operation='delete', object_type=object_type).json()
+        self._cache_write('delete', object_type, response.get(object_type))
+        return response
 
-    def update(self, object_type, object_body):
-        # [todo] - add error handling for v3 update
+    def update(self, object_type, object_body, request_id=None):
         # [todo] - validate that the object_body is a proper json blob
         constructed_url = "{}/company/{}/{}?operation=update".format(self.url_base, self.realm_id, object_type)
-        return self.session.post(constructed_url.lower(), object_body).json()
+        response = self._request('POST', _with_request_id(constructed_url.lower(), request_id),
+                                 data=entities.dump(object_body), idempotent=request_id is not None,
+                                 operation='update', object_type=object_type).json()
+        self._cache_write('update', object_type, response.get(object_type))
+        return response
+
+    def _cache_write(self, operation, object_type, entity):
+        """ Keeps the cache in step with a successful write. """
+        if self.cache is None or entity is None:
+            return
+        if operation == 'delete':
+            self.cache.evict(object_type, entity['Id'])
+        else:
+            self.cache.set(object_type, entity)
+        self.cache.invalidate_queries(object_type)
+
+
+def query_response_entities(response):
+    """ Pulls the entity list out of a v3 query response.
+
+        The entities are keyed by their type (e.g. QueryResponse.Invoice), next to the paging
+        metadata. An empty result has no entity key at all.
+    """
+    if 'Fault' in response:
+        raise fault_error(response['Fault'])
+    for value in response.get('QueryResponse', {}).values():
+        if isinstance(value, list):
+            return value
+    return []
+
+
+def cdc_changes(response):
+    """ Pulls the changed entities out of a cdc response as a dict of object type -> list. """
+    if 'Fault' in response:
+        raise fault_error(response['Fault'])
+    changes = {}
+    for cdc_response in response.get('CDCResponse', []):
+        if 'Fault' in cdc_response:
+            raise fault_error(cdc_response['Fault'])
+        for query_response in cdc_response.get('QueryResponse', []):
+            for object_type, value in query_response.items():
+                if isinstance(value, list):
+                    changes.setdefault(object_type, []).extend(value)
+    return changes
+
+
+def _paged_query(query, start_position, max_results):
+    if isinstance(query, str):
+        query = query.decode('utf-8')
+    return u"{} STARTPOSITION {} MAXRESULTS {}".format(query, start_position, max_results)
+
+
+def query_object_type(query):
+    """ Returns the entity name a query selects from, e.g. 'Invoice'. """
+    match = QUERY_OBJECT_TYPE_RE.search(query)
+    return match.group(1) if match else None
+
+
+def fault_error(fault, status_code=None, response=None):
+    """ Maps a v3 Fault payload (and/or HTTP status) to the matching QuickbooksError. """
+    fault = fault or {}
+    errors = fault.get('Error') or [{}]
+    codes = [str(error.get('code', '')) for error in errors]
+    message = '; '.join(
+        ': '.join(part for part in (error.get('Message'), error.get('Detail')) if part) for error in errors
+    )
+    fault_type = fault.get('type', '')
+    message = message or fault_type or 'HTTP {}'.format(status_code)
+
+    if status_code == 401 or fault_type == 'AuthenticationFault' or _any_in(codes, AUTHENTICATION_FAULT_CODES):
+        error_class = AuthenticationFailure
+    elif status_code in TRY_LATER_STATUSES or fault_type == 'ThrottleExceeded' or _any_in(codes, THROTTLE_FAULT_CODES):
+        error_class = TryLaterError
+    elif _any_in(codes, DUPLICATE_FAULT_CODES):
+        error_class = DuplicateItemError
+    elif _any_in(codes, STALE_OBJECT_FAULT_CODES):
+        error_class = StaleObjectError
+    else:
+        error_class = ApiError
+    return error_class(message, fault=fault or None, response=response)
+
+
+def should_retry(error, idempotent):
+    """ Whether a request that failed with `error` can safely be sent again. """
+    if isinstance(error, TryLaterError):
+        return idempotent or getattr(error.response, 'status_code', None) not in GATEWAY_ERROR_STATUSES
+    return idempotent and isinstance(error, CommunicationError)
+
+
+def response_error(response):
+    """ Returns the QuickbooksError for a failed response, or None if it succeeded. """
+    if response.status_code < 400:
+        return None
+    try:
+        fault = response.json().get('Fault')
+    except ValueError:
+        fault = None
+    return fault_error(fault, status_code=response.status_code, response=response)
+
+
+def _check_paged_query(query, page_size):
+    if PAGING_CLAUSE_RE.search(query):
+        raise ValueError("query_pages manages STARTPOSITION/MAXRESULTS itself; remove them from the query")
+    if not 0 < page_size <= MAX_QUERY_PAGE_SIZE:
+        raise ValueError("page_size must be between 1 and {}".format(MAX_QUERY_PAGE_SIZE))
+
+
+def _response_bytes(response, stream):
+    """ The body size for metrics; a streamed body hasn't been read yet, so it is taken from the headers. """
+    if response is None:
+        return 0
+    if stream:
+        try:
+            return int(response.headers.get('Content-Length') or 0)
+        except ValueError:
+            return 0
+    return len(response.content)
+
+
+def _with_request_id(url, request_id):
+    if request_id is None:
+        return url
+    return "{}{}requestid={}".format(url, '&' if '?' in url else '?', urllib.quote(str(request_id)))
+
+
+def _any_in(values, candidates):
+    return any(value in candidates for value in values)
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers['Retry-After'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def _raise_for_appcenter_error(content):
+    match = APPCENTER_ERROR_CODE_RE.search(content)
+    if match is None or match.group(1) == '0':
+        return
+    code = match.group(1)
+    message = APPCENTER_ERROR_MESSAGE_RE.search(content)
+    # Shaped like a v3 Fault, so callers can look at the code the same way.
+    fault = {'type': 'AppcenterError', 'Error': [{'code': code, 'Message': message.group(1) if message else ''}]}
+    if code in APPCENTER_AUTHENTICATION_ERROR_CODES:
+        raise AuthenticationFailure("Appcenter rejected the OAuth token (ErrorCode {})".format(code), fault=fault)
+    raise ApiError("Appcenter request failed (ErrorCode {})".format(code), fault=fault)
+
+
+def _batch_item(bid, operation):
+    """ Builds a single BatchItemRequest entry. """
+    kind = operation[0]
+    if kind not in BATCH_OPERATIONS:
+        raise ValueError("Unknown batch operation {!r}".format(kind))
+
+    if kind == 'query':
+        return {'bId': bid, 'Query': operation[1]}
+    object_type = operation[1]
+    if kind == 'read':
+        entity_id = str(operation[2]).replace("'", "\\'")
+        return {'bId': bid, 'Query': "select * from {} where Id = '{}'".format(object_type, entity_id)}
+
+    object_body = operation[2]
+    if isinstance(object_body, entities.Entity):
+        object_body = object_body.to_dict()
+    elif not isinstance(object_body, dict):
+        object_body = json.loads(object_body)
+    return {'bId': bid, 'operation': kind, object_type: object_body}
+
+
+class _PageFetch(threading.Thread):
+    """ Fetches a single query page in the background. """
+    def __init__(self, fetch, *args):
+        super(_PageFetch, self).__init__()
+        self.daemon = True
+        self._fetch = fetch
+        self._args = args
+        self._page = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        try:
+            self._page = self._fetch(*self._args)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        self.join()
+        if self._error is not None:
+            raise self._error
+        return self._page
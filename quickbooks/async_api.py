@@ -0,0 +1,143 @@
+"""
+Non-blocking access to the v3 api.
+
+AsyncQuickbooksApi mirrors the QuickbooksApi surface, but every call returns a
+concurrent.futures.Future instead of blocking. All instances share one process-wide
+worker pool (the global concurrency bound), and calls for a single realm are capped
+at Intuit's concurrent request limit. Calls over a realm's cap wait in a queue rather
+than tying up a worker thread, so one busy realm cannot starve the others.
+"""
+import threading
+from collections import deque
+
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from django.conf import settings
+from .api import QuickbooksApi
+from .throttle import DEFAULT_REALM_CONCURRENCY
+
+DEFAULT_MAX_WORKERS = 50
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_realm_limiters = {}
+_realm_limiters_lock = threading.Lock()
+
+
+def get_executor():
+    """ Returns the process-wide worker pool, creating it on first use. Its size is
+        QUICKBOOKS['ASYNC_MAX_WORKERS'].
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            max_workers = settings.QUICKBOOKS.get('ASYNC_MAX_WORKERS', DEFAULT_MAX_WORKERS)
+            _executor = ThreadPoolExecutor(max_workers=max_workers)
+        return _executor
+
+
+def get_realm_limiter(realm_id):
+    """ Returns the limiter shared by every AsyncQuickbooksApi for `realm_id`. """
+    with _realm_limiters_lock:
+        limiter = _realm_limiters.get(realm_id)
+        if limiter is None:
+            limit = settings.QUICKBOOKS.get('REALM_CONCURRENCY', DEFAULT_REALM_CONCURRENCY)
+            limiter = _realm_limiters[realm_id] = RealmLimiter(get_executor(), limit)
+        return limiter
+
+
+class RealmLimiter(object):
+    """ Keeps at most `limit` calls in flight on `executor`, queueing the rest. """
+    def __init__(self, executor, limit):
+        self.executor = executor
+        self.limit = limit
+        self._active = 0
+        self._waiting = deque()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            if self._active >= self.limit:
+                self._waiting.append((future, fn, args, kwargs))
+                return future
+            self._active += 1
+        if not self._start(future, fn, args, kwargs):
+            self._release()
+        return future
+
+    def _start(self, future, fn, args, kwargs):
+        """ Starts a call in the slot it was given. Returns False, leaving the slot to the
+            caller, if the call was cancelled while it was queued.
+        """
+        if not future.set_running_or_notify_cancel():
+            return False
+        try:
+            inner = self.executor.submit(fn, *args, **kwargs)
+        except Exception as e:
+            # E.g. the pool has been shut down.
+            future.set_exception(e)
+            return False
+        inner.add_done_callback(lambda done: self._finish(future, done))
+        return True
+
+    def _finish(self, future, done):
+        try:
+            if done.cancelled():
+                # `future` is already running, so it can only be failed, not cancelled.
+                future.set_exception(CancelledError())
+            elif done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result())
+        finally:
+            self._release()
+
+    def _release(self):
+        """ Passes the slot to the next queued call that hasn't been cancelled, or frees it.
+            A loop, not a recursion, however many queued calls were cancelled.
+        """
+        while True:
+            with self._lock:
+                if not self._waiting:
+                    self._active -= 1
+                    return
+                queued = self._waiting.popleft()
+            if self._start(*queued):
+                return
+
+
+class AsyncQuickbooksApi(object):
+    """ QuickbooksApi whose methods return Futures. """
+    def __init__(self, owner_or_token):
+        self.api = QuickbooksApi(owner_or_token)
+        self.token = self.api.token
+        self.realm_id = self.api.realm_id
+        self.limiter = get_realm_limiter(self.realm_id)
+
+    def _submit(self, method, *args, **kwargs):
+        return self.limiter.submit(method, *args, **kwargs)
+
+    def app_menu(self, retries=3):
+        return self._submit(self.api.app_menu, retries=retries)
+
+    def disconnect(self):
+        return self._submit(self.api.disconnect)
+
+    def read(self, object_type, entity_id):
+        return self._submit(self.api.read, object_type, entity_id)
+
+    def query(self, query):
+        return self._submit(self.api.query, query)
+
+    def create(self, object_type, object_body):
+        return self._submit(self.api.create, object_type, object_body)
+
+    def delete(self, object_type, object_body):
+        return self._submit(self.api.delete, object_type, object_body)
+
+    def update(self, object_type, object_body):
+        return self._submit(self.api.update, object_type, object_body)
+
+    def batch(self, operations):
+        return self._submit(self.api.batch, operations)
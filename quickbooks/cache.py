@@ -0,0 +1,256 @@
+"""
+Read-through caching of v3 entities on top of the Django cache framework.
+
+Only object types with a TTL are cached; by default those are the slow-changing
+lists (Item, Account, TaxCode, Term). Override or extend them with
+QUICKBOOKS['CACHE_TTLS'], and pick the cache with QUICKBOOKS['CACHE_ALIAS'].
+
+Every key for an object type carries that type's generation number. Bumping the
+generation drops all of the type's entries at once, which is how cached query
+results are invalidated when any entity of the type changes.
+
+AppMenuCache keeps the blue dot menu HTML for each token in the same cache, shared
+by every web worker.
+"""
+import datetime
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models.signals import post_delete
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import utc
+from .models import QuickbooksToken
+from .signals import qb_connected, qb_entity_changed, qb_token_reconnected
+
+DEFAULT_TTLS = {
+    'Item': 60 * 60,
+    'Account': 60 * 60,
+    'TaxCode': 60 * 60 * 24,
+    'Term': 60 * 60 * 24,
+}
+
+# Generation counters and the CDC watermark have to outlive the entries they cover.
+# Thirty days is the longest timeout memcached accepts.
+BOOKKEEPING_TIMEOUT = 60 * 60 * 24 * 30
+
+# The app menu is served as is for APP_MENU_TTL seconds, then served stale while a
+# background refresh runs, until it is APP_MENU_STALE_TTL seconds old.
+DEFAULT_APP_MENU_TTL = 60 * 60
+DEFAULT_APP_MENU_STALE_TTL = 60 * 60 * 24
+
+APP_MENU_REFRESH_LOCK_TIMEOUT = 60
+
+
+class EntityCache(object):
+    def __init__(self, realm_id, cache_alias=None, ttls=None):
+        options = settings.QUICKBOOKS
+        self.realm_id = realm_id
+        self.cache = get_cache(cache_alias or options.get('CACHE_ALIAS', 'default'))
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(options.get('CACHE_TTLS', {}))
+        self.ttls.update(ttls or {})
+
+    def ttl(self, object_type):
+        """ Seconds to cache `object_type` for; 0 means it is not cached. """
+        return self.ttls.get(object_type, 0)
+
+    def get(self, object_type, entity_id):
+        if not self.ttl(object_type):
+            return None
+        entry = self.cache.get(self._entity_key(object_type, entity_id))
+        return entry[1] if entry is not None else None
+
+    def set(self, object_type, entity):
+        """ Caches `entity` unless a newer version (by SyncToken) is already cached. """
+        ttl = self.ttl(object_type)
+        if not ttl:
+            return
+        key = self._entity_key(object_type, entity['Id'])
+        sync_token = _sync_token(entity)
+        current = self.cache.get(key)
+        if current is not None and current[0] > sync_token:
+            return
+        self.cache.set(key, (sync_token, entity), ttl)
+
+    def evict(self, object_type, entity_id):
+        if self.ttl(object_type):
+            self.cache.delete(self._entity_key(object_type, entity_id))
+
+    def get_query(self, object_type, query):
+        if not self.ttl(object_type):
+            return None
+        return self.cache.get(self._query_key(object_type, query))
+
+    def set_query(self, object_type, query, response):
+        ttl = self.ttl(object_type)
+        if ttl and 'Fault' not in response:
+            self.cache.set(self._query_key(object_type, query), response, ttl)
+
+    def invalidate_queries(self, object_type):
+        """ Drops every cached query result for `object_type`. """
+        if self.ttl(object_type):
+            self._bump(self._query_generation_key(object_type))
+
+    def invalidate(self, object_type):
+        """ Drops everything cached for `object_type`. """
+        if self.ttl(object_type):
+            self._bump(self._entity_generation_key(object_type))
+            self._bump(self._query_generation_key(object_type))
+
+    def apply_changes(self, changes):
+        """ Applies a dict of object type -> changed entities, as returned by cdc_changes. """
+        for object_type, entities in changes.items():
+            if not self.ttl(object_type):
+                continue
+            for entity in entities:
+                if entity.get('status') == 'Deleted':
+                    self.evict(object_type, entity['Id'])
+                else:
+                    self.set(object_type, entity)
+            if entities:
+                self.invalidate_queries(object_type)
+
+    def refresh_from_cdc(self, api, entity_types=None):
+        """ Asks ChangeDataCapture what changed since the previous refresh and evicts or updates
+            just those entities. Returns the changes. Without a usable watermark (first run, or
+            more than 30 days ago) the cached types are dropped wholesale instead.
+        """
+        from quickbooks.api import CDC_MAX_AGE, cdc_changes
+
+        if entity_types is None:
+            entity_types = sorted(object_type for object_type, ttl in self.ttls.items() if ttl)
+        watermark_key = 'quickbooks:cdc:{}:{}'.format(self.realm_id, ','.join(entity_types))
+        watermark = self.cache.get(watermark_key)
+        changed_since = parse_datetime(watermark) if watermark else None
+
+        if changed_since is None or _utcnow() - changed_since > CDC_MAX_AGE:
+            for object_type in entity_types:
+                self.invalidate(object_type)
+            changes = {}
+            watermark = _utcnow().isoformat()
+        else:
+            response = api.cdc(entity_types, watermark)
+            changes = cdc_changes(response)
+            self.apply_changes(changes)
+            watermark = response.get('time') or _utcnow().isoformat()
+
+        self.cache.set(watermark_key, watermark, BOOKKEEPING_TIMEOUT)
+        return changes
+
+    def _entity_key(self, object_type, entity_id):
+        generation = self._generation(self._entity_generation_key(object_type))
+        return 'quickbooks:entity:{}:{}:{}:{}'.format(self.realm_id, object_type, generation, entity_id)
+
+    def _query_key(self, object_type, query):
+        generation = self._generation(self._query_generation_key(object_type))
+        digest = hashlib.md5(query.encode('utf-8')).hexdigest()
+        return 'quickbooks:query:{}:{}:{}:{}'.format(self.realm_id, object_type, generation, digest)
+
+    def _entity_generation_key(self, object_type):
+        return 'quickbooks:generation:entity:{}:{}'.format(self.realm_id, object_type)
+
+    def _query_generation_key(self, object_type):
+        return 'quickbooks:generation:query:{}:{}'.format(self.realm_id, object_type)
+
+    def _generation(self, key):
+        generation = self.cache.get(key)
+        if generation is None:
+            self.cache.add(key, 1, BOOKKEEPING_TIMEOUT)
+            generation = self.cache.get(key) or 1
+        return generation
+
+    def _bump(self, key):
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # No generation yet, so nothing was cached under the old one either.
+            self.cache.add(key, 2, BOOKKEEPING_TIMEOUT)
+
+
+class AppMenuCache(object):
+    def __init__(self, cache_alias=None, ttl=None, stale_ttl=None):
+        options = settings.QUICKBOOKS
+        self.cache = get_cache(cache_alias or options.get('APP_MENU_CACHE_ALIAS',
+                                                          options.get('CACHE_ALIAS', 'default')))
+        self.ttl = ttl or options.get('APP_MENU_TTL', DEFAULT_APP_MENU_TTL)
+        self.stale_ttl = stale_ttl or options.get('APP_MENU_STALE_TTL', DEFAULT_APP_MENU_STALE_TTL)
+
+    def get(self, token):
+        """ Returns the app menu HTML for `token`. Only a missing (or fully expired) entry makes
+            the caller wait for appcenter; a stale one is returned while it is refreshed in the
+            background.
+        """
+        entry = self.cache.get(self._key(token))
+        if entry is None:
+            return self.refresh(token)
+        fetched_at, html = entry
+        if time.time() - fetched_at > self.ttl:
+            self._refresh_in_background(token)
+        return html
+
+    def refresh(self, token):
+        from quickbooks.api import QuickbooksApi
+
+        html = QuickbooksApi(token).app_menu()
+        self.cache.set(self._key(token), (time.time(), html), self.stale_ttl)
+        return html
+
+    def invalidate(self, token):
+        self.cache.delete(self._key(token))
+
+    def _refresh_in_background(self, token):
+        # Only one worker refreshes a given menu at a time.
+        if not self.cache.add(self._key(token) + ':refreshing', True, APP_MENU_REFRESH_LOCK_TIMEOUT):
+            return
+
+        def run():
+            try:
+                self.refresh(token)
+            except Exception:
+                logging.getLogger('quickbooks.cache').exception("Couldn't refresh the app menu for realm %s",
+                                                                token.realm_id)
+            finally:
+                self.cache.delete(self._key(token) + ':refreshing')
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def _key(self, token):
+        return 'quickbooks:app_menu:{}:{}'.format(token.realm_id, token.pk)
+
+
+app_menu_cache = AppMenuCache()
+
+
+def _invalidate_app_menu(sender, token=None, instance=None, **kwargs):
+    app_menu_cache.invalidate(token or instance)
+
+
+post_delete.connect(_invalidate_app_menu, sender=QuickbooksToken, dispatch_uid='quickbooks.cache.post_delete')
+qb_connected.connect(_invalidate_app_menu, dispatch_uid='quickbooks.cache.qb_connected')
+qb_token_reconnected.connect(_invalidate_app_menu, dispatch_uid='quickbooks.cache.qb_token_reconnected')
+
+
+def _evict_changed_entity(sender, token, entity_type, entity_id, **kwargs):
+    cache = EntityCache(token.realm_id)
+    cache.evict(entity_type, entity_id)
+    cache.invalidate_queries(entity_type)
+
+
+qb_entity_changed.connect(_evict_changed_entity, dispatch_uid='quickbooks.cache.qb_entity_changed')
+
+
+def _utcnow():
+    return datetime.datetime.utcnow().replace(tzinfo=utc)
+
+
+def _sync_token(entity):
+    try:
+        return int(entity.get('SyncToken', 0))
+    except (TypeError, ValueError):
+        return 0
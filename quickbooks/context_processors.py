@@ -1,5 +1,17 @@
+from django.utils.functional import SimpleLazyObject, empty
 from .models import find_quickbooks_token
 
 
+class LazyToken(SimpleLazyObject):
+    """ Defers the token lookup until a template actually uses qb_token. Unlike a plain
+        SimpleLazyObject it is falsy when there is no token, so {% if qb_token %} works.
+    """
+    def __nonzero__(self):
+        if self._wrapped is empty:
+            self._setup()
+        return bool(self._wrapped)
+    __bool__ = __nonzero__
+
+
 def token(request):
-    return {'qb_token': find_quickbooks_token(request)}
+    return {'qb_token': LazyToken(lambda: find_quickbooks_token(request))}
@@ -0,0 +1,220 @@
+"""
+Compact, typed wrappers for the most common v3 entities.
+
+Each entity class keeps its scalar fields in __slots__. Nested values (refs, Line
+arrays, addresses, MetaData) are stored as compact JSON strings and only decoded
+the first time they are read. Fields the class does not know about are kept too,
+so an entity always round-trips back to the JSON it came from.
+
+    invoice = load('Invoice', api.read('Invoice', 42)['Invoice'])
+    invoice.TotalAmt, invoice.CustomerRef.value, invoice.Line[0]['Amount']
+    api.update('Invoice', invoice)
+"""
+import json
+
+_registry = {}
+
+_COMPACT = (',', ':')
+
+
+class _RawJSON(str):
+    """ A nested value that has not been decoded yet. """
+    __slots__ = ()
+
+
+class Ref(object):
+    """ A reference to another entity, e.g. CustomerRef. """
+    __slots__ = ('value', 'name', 'type')
+
+    def __init__(self, value=None, name=None, type=None):
+        self.value = value
+        self.name = name
+        self.type = type
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('value'), data.get('name'), data.get('type'))
+
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__ if getattr(self, key) is not None)
+
+    def __eq__(self, other):
+        return isinstance(other, Ref) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Ref({!r}, {!r})'.format(self.value, self.name)
+
+
+class _Lazy(object):
+    """ Descriptor that decodes a nested value from its slot on first access. """
+    def __init__(self, slot, decode):
+        self.slot = slot
+        self.decode = decode
+
+    def __get__(self, entity, cls):
+        if entity is None:
+            return self
+        value = getattr(entity, self.slot)
+        if isinstance(value, _RawJSON):
+            value = self.decode(json.loads(value))
+            setattr(entity, self.slot, value)
+        return value
+
+    def __set__(self, entity, value):
+        setattr(entity, self.slot, value)
+
+
+def _decode_ref(data):
+    return Ref.from_dict(data)
+
+
+def _decode_nested(data):
+    return data
+
+
+class EntityMeta(type):
+    """ Builds __slots__ and lazy accessors from the `fields`, `refs` and `nested` a class
+        declares, and registers classes that set `object_type`.
+    """
+    def __new__(mcs, name, bases, attrs):
+        fields = tuple(attrs.get('fields', ()))
+        refs = tuple(attrs.get('refs', ()))
+        nested = tuple(attrs.get('nested', ()))
+        attrs['__slots__'] = tuple(attrs.get('__slots__', ())) + fields + tuple('_' + key for key in refs + nested)
+        for key in refs:
+            attrs[key] = _Lazy('_' + key, _decode_ref)
+        for key in nested:
+            attrs[key] = _Lazy('_' + key, _decode_nested)
+
+        cls = super(EntityMeta, mcs).__new__(mcs, name, bases, attrs)
+        cls._fields = getattr(cls, '_fields', ()) + fields
+        cls._refs = getattr(cls, '_refs', ()) + refs
+        cls._nested = getattr(cls, '_nested', ()) + nested
+        cls._lazy = frozenset(cls._refs + cls._nested)
+        if attrs.get('object_type'):
+            _registry[attrs['object_type']] = cls
+        return cls
+
+
+class Entity(EntityMeta('_EntityBase', (object,), {})):
+    __slots__ = ('_extra',)
+    object_type = None
+    fields = ('Id', 'SyncToken', 'domain', 'sparse')
+    nested = ('MetaData',)
+
+    def __init__(self, **values):
+        for key in self._fields:
+            setattr(self, key, None)
+        for key in self._lazy:
+            setattr(self, '_' + key, None)
+        self._extra = None
+        for key, value in values.items():
+            setattr(self, key, value)
+
+    @classmethod
+    def from_dict(cls, data):
+        entity = cls()
+        extra = {}
+        for key, value in data.items():
+            if key in cls._lazy:
+                setattr(entity, '_' + key, _RawJSON(json.dumps(value, separators=_COMPACT)))
+            elif key in cls._fields:
+                setattr(entity, key, value)
+            else:
+                extra[key] = value
+        if extra:
+            entity._extra = _RawJSON(json.dumps(extra, separators=_COMPACT))
+        return entity
+
+    def to_dict(self):
+        data = json.loads(self._extra) if self._extra is not None else {}
+        for key in self._fields:
+            value = getattr(self, key)
+            if value is not None:
+                data[key] = value
+        for key in self._lazy:
+            # Values that were never read are passed through without decoding them.
+            value = getattr(self, '_' + key)
+            if isinstance(value, _RawJSON):
+                data[key] = json.loads(value)
+            elif isinstance(value, Ref):
+                data[key] = value.to_dict()
+            elif value is not None:
+                data[key] = value
+        return data
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=_COMPACT)
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.Id)
+
+
+class Customer(Entity):
+    object_type = 'Customer'
+    fields = ('DisplayName', 'Title', 'GivenName', 'MiddleName', 'FamilyName', 'Suffix', 'CompanyName',
+              'FullyQualifiedName', 'PrintOnCheckName', 'Active', 'Taxable', 'Job', 'BillWithParent',
+              'Balance', 'BalanceWithJobs', 'PreferredDeliveryMethod', 'Notes')
+    refs = ('ParentRef', 'CurrencyRef', 'SalesTermRef', 'PaymentMethodRef', 'DefaultTaxCodeRef')
+    nested = ('BillAddr', 'ShipAddr', 'PrimaryEmailAddr', 'PrimaryPhone', 'Mobile', 'Fax', 'WebAddr')
+
+
+class Invoice(Entity):
+    object_type = 'Invoice'
+    fields = ('DocNumber', 'TxnDate', 'DueDate', 'ShipDate', 'TotalAmt', 'Balance', 'Deposit',
+              'PrivateNote', 'ApplyTaxAfterDiscount', 'PrintStatus', 'EmailStatus', 'GlobalTaxCalculation')
+    refs = ('CustomerRef', 'CurrencyRef', 'SalesTermRef', 'DepartmentRef', 'ClassRef', 'ShipMethodRef',
+            'DepositToAccountRef')
+    nested = ('Line', 'TxnTaxDetail', 'LinkedTxn', 'CustomField', 'CustomerMemo', 'BillAddr', 'ShipAddr',
+              'BillEmail')
+
+
+class Item(Entity):
+    object_type = 'Item'
+    fields = ('Name', 'Description', 'Active', 'SubItem', 'FullyQualifiedName', 'Type', 'Taxable', 'UnitPrice',
+              'PurchaseDesc', 'PurchaseCost', 'TrackQtyOnHand', 'QtyOnHand', 'InvStartDate', 'Sku', 'Level')
+    refs = ('ParentRef', 'IncomeAccountRef', 'ExpenseAccountRef', 'AssetAccountRef', 'SalesTaxCodeRef')
+
+
+class Account(Entity):
+    object_type = 'Account'
+    fields = ('Name', 'AcctNum', 'Description', 'SubAccount', 'FullyQualifiedName', 'Active', 'Classification',
+              'AccountType', 'AccountSubType', 'CurrentBalance', 'CurrentBalanceWithSubAccounts')
+    refs = ('ParentRef', 'CurrencyRef')
+
+
+class Payment(Entity):
+    object_type = 'Payment'
+    fields = ('TxnDate', 'TotalAmt', 'UnappliedAmt', 'ProcessPayment', 'PaymentRefNum', 'PrivateNote')
+    refs = ('CustomerRef', 'CurrencyRef', 'ARAccountRef', 'DepositToAccountRef', 'PaymentMethodRef')
+    nested = ('Line',)
+
+
+class Bill(Entity):
+    object_type = 'Bill'
+    fields = ('DocNumber', 'TxnDate', 'DueDate', 'TotalAmt', 'Balance', 'PrivateNote')
+    refs = ('VendorRef', 'APAccountRef', 'CurrencyRef', 'SalesTermRef', 'DepartmentRef')
+    nested = ('Line', 'LinkedTxn', 'TxnTaxDetail')
+
+
+def entity_class(object_type):
+    """ Returns the Entity subclass for `object_type`, or None if there is none. """
+    return _registry.get(object_type)
+
+
+def load(object_type, data):
+    """ Wraps an entity dict in its Entity class; types without one are returned as is. """
+    cls = _registry.get(object_type)
+    return cls.from_dict(data) if cls is not None else data
+
+
+def dump(object_body):
+    """ Serializes an Entity (or dict) for create/update. JSON strings are passed through. """
+    if isinstance(object_body, Entity):
+        return object_body.to_json()
+    if isinstance(object_body, dict):
+        return json.dumps(object_body, separators=_COMPACT)
+    return object_body
@@ -0,0 +1,156 @@
+"""
+Bulk export of a realm's entities to newline-delimited JSON or CSV files.
+
+Entities are streamed page by page from paginated queries, so memory use does not
+grow with the size of the realm. Each page is appended to <output_dir>/<Type>.<format>
+(as its own gzip member when compressing), after which the checkpoint file, if one is
+used, records how far the export got. Re-running with the same checkpoint picks up at
+the last completed page, cutting off anything a crash left half-written.
+
+CSV rows are flattened: nested objects become dotted columns (CustomerRef.value) and
+lists (e.g. Line) are JSON-encoded into a single column. The columns are those
+passed as `columns`, or else taken from the first page of each type; fields that
+aren't among them are dropped, logged as a warning and reported in the stats.
+"""
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import time
+
+from .api import MAX_QUERY_PAGE_SIZE
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+FORMATS = (NDJSON, CSV)
+
+logger = logging.getLogger('quickbooks.export')
+
+
+def export_entities(api, entity_types, output_dir, format=NDJSON, compress=False,
+                    page_size=MAX_QUERY_PAGE_SIZE, checkpoint_path=None, columns=None):
+    """ Exports every entity of `entity_types` through `api` and returns a dict of entity
+        type -> stats (rows, bytes, seconds, dropped_fields, skipped). `columns` fixes the
+        CSV columns of every type.
+    """
+    if format not in FORMATS:
+        raise ValueError("format must be one of {}".format(', '.join(FORMATS)))
+
+    checkpoint = {}
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if (checkpoint['format'], checkpoint['compress']) != (format, compress):
+            raise ValueError("The checkpoint belongs to a {} export".format(
+                checkpoint['format'] + (' (gzip)' if checkpoint['compress'] else '')))
+    checkpoint.update(format=format, compress=compress)
+    states = checkpoint.setdefault('types', {})
+
+    def save_checkpoint():
+        if checkpoint_path:
+            _write_checkpoint(checkpoint_path, checkpoint)
+
+    stats = {}
+    for entity_type in entity_types:
+        filename = '{}.{}{}'.format(entity_type, format, '.gz' if compress else '')
+        stats[entity_type] = _export_type(api, entity_type, os.path.join(output_dir, filename), format,
+                                          compress, page_size, states.setdefault(entity_type, {}),
+                                          save_checkpoint, columns)
+    return stats
+
+
+def flatten(entity, prefix=''):
+    """ Flattens nested objects into dotted keys; lists are JSON-encoded. """
+    flat = {}
+    for key, value in entity.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, list):
+            flat[name] = json.dumps(value, separators=(',', ':'))
+        else:
+            flat[name] = value
+    return flat
+
+
+def _export_type(api, entity_type, path, format, compress, page_size, state, save_checkpoint, columns):
+    stats = {'rows': 0, 'bytes': 0, 'seconds': 0.0, 'dropped_fields': [], 'skipped': False}
+    if state.get('done'):
+        stats['skipped'] = True
+        return stats
+
+    started = time.time()
+    if state.get('offset'):
+        # Drop whatever was written after the last checkpoint.
+        with open(path, 'r+b') as output:
+            output.truncate(state['offset'])
+    elif os.path.exists(path):
+        os.remove(path)
+
+    columns = state.get('columns') or (list(columns) if columns else None)
+    dropped = set()
+    position = state.get('position', 1)
+    # Paging is only stable in a fixed order.
+    query = "select * from {} orderby Id".format(entity_type)
+
+    for page in api.query_pages(query, page_size=page_size, start_position=position, prefetch=True):
+        if format == CSV:
+            rows = [flatten(entity) for entity in page]
+            # The checkpoint records the columns once the header is written.
+            write_header = not state.get('columns')
+            if columns is None:
+                columns = sorted(set().union(*rows))
+            for row in rows:
+                dropped.update(set(row) - set(columns))
+            data = _csv_page(rows, columns, write_header)
+        else:
+            data = ''.join(json.dumps(entity, separators=(',', ':')) + '\n' for entity in page)
+            data = data.encode('utf-8')
+
+        opener = gzip.open if compress else open
+        with opener(path, 'ab') as output:
+            output.write(data)
+
+        position += len(page)
+        stats['rows'] += len(page)
+        stats['bytes'] += len(data)
+        state.update(position=position, offset=os.path.getsize(path), columns=columns)
+        save_checkpoint()
+
+    state['done'] = True
+    save_checkpoint()
+    stats['seconds'] = time.time() - started
+    stats['dropped_fields'] = sorted(dropped)
+    if dropped:
+        logger.warning("%s fields missing from the CSV columns were dropped: %s", entity_type,
+                       ', '.join(stats['dropped_fields']))
+    return stats
+
+
+def _csv_page(rows, columns, write_header):
+    buf = io.BytesIO()
+    writer = csv.writer(buf)
+    if write_header:
+        writer.writerow([_csv_value(column) for column in columns])
+    for row in rows:
+        writer.writerow([_csv_value(row.get(column)) for column in columns])
+    return buf.getvalue()
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _write_checkpoint(path, checkpoint):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.rename(temp_path, path)
@@ -0,0 +1,82 @@
+"""
+Runs the same piece of work against many realms at once.
+
+fan_out calls fn(QuickbooksApi(token)) for every token on a bounded thread (or
+process) pool and yields a FanOutResult for each token as soon as it finishes, so
+one slow realm does not hold up the others. Tokens that share a realm are run one
+after another, in the order given, which keeps per-realm ordering and stays well
+inside Intuit's per-realm concurrency limit.
+"""
+from collections import namedtuple, OrderedDict
+from Queue import Queue
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from django.conf import settings
+from django.db import connection, connections
+from .api import QuickbooksApi
+
+DEFAULT_FAN_OUT_MAX_WORKERS = 8
+
+# Database connections a forked worker inherited. They stay referenced so that they are never
+# garbage collected, which would close them and end the sessions the parent is still using.
+_inherited_connections = []
+
+
+class FanOutResult(namedtuple('FanOutResult', 'token result exception')):
+    """ `result` is what fn returned for `token`, or None if it raised `exception`. """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.exception is None
+
+
+def fan_out(tokens, fn, max_workers=None, processes=False):
+    """ Yields a FanOutResult per token, in completion order.
+
+        With `processes` the work runs in a process pool instead; `fn` must then be a
+        module-level function, and results for a realm are yielded once all of that realm's
+        tokens are done.
+    """
+    tokens = list(tokens)
+    realms = OrderedDict()
+    for token in tokens:
+        realms.setdefault(token.realm_id, []).append(token)
+    max_workers = max_workers or settings.QUICKBOOKS.get('FAN_OUT_MAX_WORKERS', DEFAULT_FAN_OUT_MAX_WORKERS)
+
+    if processes:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_run_realm_in_process, realm_tokens, fn) for realm_tokens in realms.values()]
+            for future in as_completed(futures):
+                for result in future.result():
+                    yield result
+    else:
+        results = Queue()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for realm_tokens in realms.values():
+                executor.submit(_run_realm, realm_tokens, fn, results.put)
+            for _ in range(len(tokens)):
+                yield results.get()
+
+
+def _run_realm(tokens, fn, emit):
+    for token in tokens:
+        try:
+            result = FanOutResult(token, fn(QuickbooksApi(token)), None)
+        except Exception as e:
+            result = FanOutResult(token, None, e)
+        emit(result)
+    # Pool threads outlive the work; don't leave their database connections open.
+    connection.close()
+
+
+def _run_realm_in_process(tokens, fn):
+    # The worker opens its own connections; the parent's (and any transaction it has open)
+    # are left alone.
+    for conn in connections.all():
+        if conn.connection is not None:
+            _inherited_connections.append(conn.connection)
+            conn.connection = None
+    results = []
+    _run_realm(tokens, fn, results.append)
+    return results
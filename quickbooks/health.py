@@ -0,0 +1,112 @@
+"""
+Keeps QuickBooks tokens alive, off the request path.
+
+Intuit's access tokens expire 180 days after they are issued, and can only be
+renewed through the appcenter reconnect endpoint in the last 30 of those days.
+refresh_expiring_tokens reconnects every active token inside that window (and
+every token whose age is unknown), stores the new credentials and sends
+qb_token_reconnected. Tokens Intuit rejects are marked inactive and sent as
+qb_token_dead, so the app can ask their users to connect again.
+
+Run it daily, from cron with the qb_refresh_tokens management command or from
+your own scheduler:
+
+    from quickbooks.health import refresh_expiring_tokens
+    refresh_expiring_tokens()
+"""
+import datetime
+import logging
+
+from django.db.models import Q
+from django.utils import timezone
+from .api import APPCENTER_RECONNECT_WINDOW_ERROR_CODE, AuthenticationFailure, QuickbooksApi
+# Connects the receiver that drops a reconnected token's app menu.
+from . import cache  # noqa
+from .fanout import fan_out
+from .models import QuickbooksToken
+from .signals import qb_token_dead, qb_token_reconnected
+
+RECONNECT_WINDOW_DAYS = 30
+
+logger = logging.getLogger('quickbooks.health')
+
+
+def tokens_due_for_reconnect(days=RECONNECT_WINDOW_DAYS):
+    """ Active tokens that expire within `days`, or whose expiry is unknown. """
+    horizon = timezone.now() + datetime.timedelta(days=days)
+    return QuickbooksToken.objects.filter(is_active=True).filter(
+        Q(expires_at__lte=horizon) | Q(expires_at__isnull=True))
+
+
+def refresh_expiring_tokens(days=RECONNECT_WINDOW_DAYS, tokens=None, max_workers=None):
+    """ Reconnects `tokens` (by default those due within `days`) and returns how many
+        were 'reconnected', found 'dead', 'skipped' as outside Intuit's window, or 'failed'
+        for some other reason (and will be tried again next time).
+    """
+    if tokens is None:
+        tokens = tokens_due_for_reconnect(days)
+    counts = {'reconnected': 0, 'dead': 0, 'skipped': 0, 'failed': 0}
+
+    # The appcenter calls run concurrently; the results are stored from this thread.
+    for result in fan_out(tokens, _reconnect, max_workers=max_workers):
+        token = result.token
+        if result.ok:
+            # Intuit has already replaced the old credentials, so one that can't be stored
+            # mustn't keep the rest from being stored.
+            try:
+                store_reconnected_token(token, *result.result)
+            except Exception:
+                logger.exception("Couldn't store the reconnected QuickBooks token for realm %s", token.realm_id)
+                counts['failed'] += 1
+                continue
+            counts['reconnected'] += 1
+        elif isinstance(result.exception, AuthenticationFailure):
+            mark_token_dead(token, str(result.exception))
+            counts['dead'] += 1
+        elif APPCENTER_RECONNECT_WINDOW_ERROR_CODE in _fault_codes(result.exception):
+            counts['skipped'] += 1
+        else:
+            logger.warning("Couldn't reconnect the QuickBooks token for realm %s: %s", token.realm_id,
+                           result.exception)
+            counts['failed'] += 1
+    return counts
+
+
+def reconnect_token(token):
+    """ Reconnects a single token right away. Raises the QuickbooksError if that fails,
+        after marking the token dead if Intuit rejected it.
+    """
+    try:
+        credentials = QuickbooksApi(token).reconnect()
+    except AuthenticationFailure as e:
+        mark_token_dead(token, str(e))
+        raise
+    store_reconnected_token(token, *credentials)
+    return token
+
+
+def store_reconnected_token(token, access_token, access_token_secret):
+    token.access_token = access_token
+    token.access_token_secret = access_token_secret
+    token.set_issued()
+    token.is_active = True
+    token.save()
+    qb_token_reconnected.send(sender=None, token=token)
+
+
+def mark_token_dead(token, reason):
+    """ Marks `token` as rejected by Intuit and sends qb_token_dead. """
+    logger.warning("QuickBooks token for realm %s is no longer valid: %s", token.realm_id, reason)
+    token.is_active = False
+    if token.pk is not None:
+        token.save()
+    qb_token_dead.send(sender=None, token=token, reason=reason)
+
+
+def _reconnect(api):
+    return api.reconnect()
+
+
+def _fault_codes(error):
+    fault = getattr(error, 'fault', None) or {}
+    return [str(item.get('code', '')) for item in fault.get('Error', [])]
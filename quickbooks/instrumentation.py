@@ -0,0 +1,144 @@
+"""
+Metrics for every request QuickbooksApi makes.
+
+Each call through the transport produces one RequestMetric, covering all of its
+retries. Metrics go to the sinks listed (as dotted paths) in
+QUICKBOOKS['METRICS_SINKS'] or registered with add_sink, and are also sent as the
+qb_post_request signal. qb_pre_request is sent before the first attempt. A sink or
+signal receiver that fails is logged and doesn't affect the request.
+
+    QUICKBOOKS['METRICS_SINKS'] = ['quickbooks.instrumentation.LoggingSink']
+"""
+import importlib
+import logging
+import socket
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+from .signals import qb_post_request
+
+logger = logging.getLogger('quickbooks.metrics')
+
+_sinks = None
+_sinks_lock = threading.Lock()
+
+
+class RequestMetric(namedtuple('RequestMetric', 'operation object_type realm_id method status latency request_bytes '
+                                                'response_bytes retries throttles throttle_wait error')):
+    """ `latency` and `throttle_wait` are in seconds. `status` is the last HTTP status (None if no
+        response arrived), `throttles` the number of throttle faults retried, and `error` the
+        name of the exception raised, if any.
+    """
+    __slots__ = ()
+
+
+def get_sinks():
+    global _sinks
+    with _sinks_lock:
+        if _sinks is None:
+            _sinks = []
+            for path in settings.QUICKBOOKS.get('METRICS_SINKS', ()):
+                module_name, class_name = path.rsplit('.', 1)
+                _sinks.append(getattr(importlib.import_module(module_name), class_name)())
+        return list(_sinks)
+
+
+def add_sink(sink):
+    get_sinks()
+    with _sinks_lock:
+        _sinks.append(sink)
+
+
+def remove_sink(sink):
+    get_sinks()
+    with _sinks_lock:
+        _sinks.remove(sink)
+
+
+def record(metric):
+    for sink in get_sinks():
+        try:
+            sink.record(metric)
+        except Exception:
+            logger.exception("Metrics sink %r failed", sink)
+    send_signal(qb_post_request, metric=metric)
+
+
+def send_signal(signal, **kwargs):
+    """ Sends `signal`, logging rather than raising the exceptions of its receivers. """
+    for receiver, response in signal.send_robust(sender=None, **kwargs):
+        if isinstance(response, Exception):
+            logger.error("Signal receiver %r failed: %r", receiver, response)
+
+
+class LoggingSink(object):
+    """ Logs one line per request to the quickbooks.metrics logger. """
+    def record(self, metric):
+        logger.info("%s %s realm=%s status=%s latency=%.3fs sent=%dB received=%dB retries=%d throttles=%d "
+                    "throttle_wait=%.3fs error=%s", metric.operation, metric.object_type or '-', metric.realm_id,
+                    metric.status, metric.latency, metric.request_bytes, metric.response_bytes, metric.retries,
+                    metric.throttles, metric.throttle_wait, metric.error or '-')
+
+
+class StatsdSink(object):
+    """ Sends statsd timers and counters over UDP, to QUICKBOOKS['STATSD_HOST'] and
+        QUICKBOOKS['STATSD_PORT'], under QUICKBOOKS['STATSD_PREFIX'].
+    """
+    def __init__(self, host=None, port=None, prefix=None):
+        options = settings.QUICKBOOKS
+        self.address = (host or options.get('STATSD_HOST', '127.0.0.1'), port or options.get('STATSD_PORT', 8125))
+        self.prefix = prefix or options.get('STATSD_PREFIX', 'quickbooks')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, metric):
+        name = '{}.{}.{}'.format(self.prefix, metric.operation, metric.object_type or 'all')
+        lines = ['{}.latency:{}|ms'.format(name, int(metric.latency * 1000)),
+                 '{}.requests:1|c'.format(name),
+                 '{}.request_bytes:{}|c'.format(name, metric.request_bytes),
+                 '{}.response_bytes:{}|c'.format(name, metric.response_bytes)]
+        if metric.status is not None:
+            lines.append('{}.status.{}:1|c'.format(name, metric.status))
+        if metric.retries:
+            lines.append('{}.retries:{}|c'.format(name, metric.retries))
+        if metric.throttles:
+            lines.append('{}.throttles:{}|c'.format(name, metric.throttles))
+        if metric.throttle_wait:
+            lines.append('{}.throttle_wait:{}|ms'.format(name, int(metric.throttle_wait * 1000)))
+        if metric.error:
+            lines.append('{}.errors.{}:1|c'.format(name, metric.error))
+        try:
+            self.socket.sendto('\n'.join(lines).encode('ascii'), self.address)
+        except socket.error:
+            # Metrics are best effort.
+            pass
+
+
+class MemorySink(object):
+    """ Keeps every metric in memory. Meant for tests and benchmarks. """
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def record(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+
+    def clear(self):
+        with self._lock:
+            del self.metrics[:]
+
+    def values(self, field='latency', **filters):
+        """ The sorted values of `field` over the metrics matching `filters`, e.g.
+            values('latency', operation='query').
+        """
+        with self._lock:
+            metrics = list(self.metrics)
+        return sorted(getattr(metric, field) for metric in metrics
+                      if all(getattr(metric, key) == value for key, value in filters.items()))
+
+    def percentile(self, percent, field='latency', **filters):
+        values = self.values(field, **filters)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
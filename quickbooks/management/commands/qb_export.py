@@ -0,0 +1,58 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from quickbooks.api import MAX_QUERY_PAGE_SIZE, QuickbooksApi
+from quickbooks.export import FORMATS, NDJSON, export_entities
+from quickbooks.models import QuickbooksToken
+
+
+class Command(BaseCommand):
+    help = "Exports a realm's entities to newline-delimited JSON or CSV files, one file per entity type."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--realm', dest='realm', help='Realm id to export.'),
+        make_option('--types', dest='types', help='Comma separated entity types to export.'),
+        make_option('--format', dest='format', default=NDJSON, choices=FORMATS,
+                    help='Output format: {} (default: %default).'.format(' or '.join(FORMATS))),
+        make_option('--output-dir', dest='output_dir', default='.',
+                    help='Directory to write the files to (default: current directory).'),
+        make_option('--gzip', action='store_true', dest='compress', default=False,
+                    help='Gzip the output files.'),
+        make_option('--checkpoint', dest='checkpoint',
+                    help='Checkpoint file; re-run with the same file to resume an interrupted export.'),
+        make_option('--columns', dest='columns',
+                    help='Comma separated CSV columns (e.g. Id,CustomerRef.value), instead of those of the '
+                         'first page of each type.'),
+        make_option('--page-size', dest='page_size', type='int', default=MAX_QUERY_PAGE_SIZE,
+                    help='Entities per query page (default: %default).'),
+    )
+
+    def handle(self, *args, **options):
+        if not options['realm'] or not options['types']:
+            raise CommandError('--realm and --types are required')
+        try:
+            token = QuickbooksToken.objects.filter(realm_id=options['realm'], is_active=True)[0]
+        except IndexError:
+            raise CommandError('No active QuickBooks token exists for realm {}'.format(options['realm']))
+        entity_types = [entity_type.strip() for entity_type in options['types'].split(',') if entity_type.strip()]
+        columns = None
+        if options['columns']:
+            columns = [column.strip() for column in options['columns'].split(',') if column.strip()]
+
+        stats = export_entities(QuickbooksApi(token), entity_types, options['output_dir'],
+                                format=options['format'], compress=options['compress'],
+                                page_size=options['page_size'], checkpoint_path=options['checkpoint'],
+                                columns=columns)
+
+        for entity_type in entity_types:
+            type_stats = stats[entity_type]
+            if type_stats['skipped']:
+                self.stdout.write('{}: already exported\n'.format(entity_type))
+                continue
+            seconds = type_stats['seconds']
+            self.stdout.write('{}: {} rows, {:.1f} MB in {:.1f}s ({:.0f} rows/s)\n'.format(
+                entity_type, type_stats['rows'], type_stats['bytes'] / 1048576.0, seconds,
+                type_stats['rows'] / seconds if seconds else 0))
+            if type_stats['dropped_fields']:
+                self.stderr.write('  WARNING: fields not in the CSV columns were dropped: {} '
+                                  '(pass --columns to include them)\n'.format(', '.join(type_stats['dropped_fields'])))
@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from quickbooks.health import RECONNECT_WINDOW_DAYS, refresh_expiring_tokens, tokens_due_for_reconnect
+
+
+class Command(BaseCommand):
+    help = ("Reconnects the QuickBooks tokens that are about to expire, and marks the ones Intuit "
+            "rejects as inactive. Meant to be run daily.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=RECONNECT_WINDOW_DAYS,
+                    help='Reconnect tokens expiring within this many days (default: %default).'),
+        make_option('--realm', action='append', dest='realms', default=[],
+                    help='Only reconnect this realm id. May be given more than once.'),
+    )
+
+    def handle(self, *args, **options):
+        tokens = tokens_due_for_reconnect(options['days'])
+        if options['realms']:
+            tokens = tokens.filter(realm_id__in=options['realms'])
+
+        counts = refresh_expiring_tokens(tokens=tokens)
+        self.stdout.write('{reconnected} reconnected, {dead} dead, {skipped} outside the reconnect window, '
+                          '{failed} failed\n'.format(**counts))
@@ -0,0 +1,48 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from quickbooks.api import QuickbooksError
+from quickbooks.mirror import mirrored_types, refresh_mirror
+from quickbooks.models import QuickbooksToken
+from quickbooks.sync import DEFAULT_SYNC_TYPES, sync
+
+
+class Command(BaseCommand):
+    help = ("Pulls the entities that changed since the last sync for every active QuickBooks token "
+            "(or just those of the given realms) and sends them as qb_entity_synced signals.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--realm', action='append', dest='realms', default=[],
+                    help='Only sync this realm id. May be given more than once.'),
+        make_option('--types', dest='types', default=','.join(DEFAULT_SYNC_TYPES),
+                    help='Comma separated entity types to sync (default: %default).'),
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help='Ignore the stored watermarks and walk every entity.'),
+    )
+
+    def handle(self, *args, **options):
+        entity_types = [entity_type.strip() for entity_type in options['types'].split(',') if entity_type.strip()]
+        tokens = QuickbooksToken.objects.filter(is_active=True)
+        if options['realms']:
+            tokens = tokens.filter(realm_id__in=options['realms'])
+
+        failed = 0
+        for token in tokens:
+            # Mirrored types go through refresh_mirror, which writes the mirror in bulk.
+            mirrored = [entity_type for entity_type in entity_types if entity_type in mirrored_types()]
+            others = [entity_type for entity_type in entity_types if entity_type not in mirrored]
+            counts = {}
+            try:
+                if mirrored:
+                    counts.update(refresh_mirror(token, mirrored, full=options['full']))
+                if others:
+                    counts.update(sync(token, others, full=options['full']))
+            except QuickbooksError as e:
+                # One realm failing shouldn't keep the others from being synced.
+                self.stderr.write('Realm {}: {}: {}\n'.format(token.realm_id, type(e).__name__, e))
+                failed += 1
+                continue
+            summary = ', '.join('{}={}'.format(entity_type, counts[entity_type]) for entity_type in entity_types)
+            self.stdout.write('Realm {}: {}\n'.format(token.realm_id, summary))
+        if failed:
+            raise CommandError("Couldn't sync {} token(s), see above".format(failed))
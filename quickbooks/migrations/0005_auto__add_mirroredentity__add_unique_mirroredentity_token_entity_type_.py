@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'MirroredEntity'
+        db.create_table(u'quickbooks_mirroredentity', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('token', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['quickbooks.QuickbooksToken'])),
+            ('entity_type', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('entity_id', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('sync_token', self.gf('django.db.models.fields.CharField')(max_length=32)),
+            ('last_updated', self.gf('django.db.models.fields.DateTimeField')(null=True, db_index=True)),
+            ('display_name', self.gf('django.db.models.fields.CharField')(db_index=True, max_length=255, blank=True)),
+            ('doc_number', self.gf('django.db.models.fields.CharField')(db_index=True, max_length=64, blank=True)),
+            ('data', self.gf('django.db.models.fields.TextField')()),
+            ('mirrored_at', self.gf('django.db.models.fields.DateTimeField')()),
+        ))
+        db.send_create_signal(u'quickbooks', ['MirroredEntity'])
+
+        # Adding unique constraint on 'MirroredEntity', fields ['token', 'entity_type', 'entity_id']
+        db.create_unique(u'quickbooks_mirroredentity', ['token_id', 'entity_type', 'entity_id'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'MirroredEntity', fields ['token', 'entity_type', 'entity_id']
+        db.delete_unique(u'quickbooks_mirroredentity', ['token_id', 'entity_type', 'entity_id'])
+
+        # Deleting model 'MirroredEntity'
+        db.delete_table(u'quickbooks_mirroredentity')
+
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Group']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Permission']"}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'quickbooks.mirroredentity': {
+            'Meta': {'unique_together': "(('token', 'entity_type', 'entity_id'),)", 'object_name': 'MirroredEntity'},
+            'data': ('django.db.models.fields.TextField', [], {}),
+            'display_name': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '255', 'blank': 'True'}),
+            'doc_number': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '64', 'blank': 'True'}),
+            'entity_id': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'entity_type': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_updated': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True'}),
+            'mirrored_at': ('django.db.models.fields.DateTimeField', [], {}),
+            'sync_token': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'token': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['quickbooks.QuickbooksToken']"})
+        },
+        u'quickbooks.quickbookssyncstate': {
+            'Meta': {'unique_together': "(('token', 'entity_type'),)", 'object_name': 'QuickbooksSyncState'},
+            'entity_type': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_synced': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'token': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['quickbooks.QuickbooksToken']"})
+        },
+        u'quickbooks.quickbookstoken': {
+            'Meta': {'object_name': 'QuickbooksToken'},
+            'access_token': ('django.db.models.fields.CharField', [], {'max_length': '406'}),
+            'access_token_secret': ('django.db.models.fields.CharField', [], {'max_length': '406'}),
+            'data_source': ('django.db.models.fields.CharField', [], {'max_length': '10'}),
+            'expires_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'issued_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'last_used_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'realm_id': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        }
+    }
+
+    complete_apps = ['quickbooks']
\ No newline at end of file
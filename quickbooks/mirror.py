@@ -0,0 +1,211 @@
+"""
+An optional local copy of realm data, for lookups that shouldn't go to Intuit.
+
+Entities of the types listed in QUICKBOOKS['MIRROR_TYPES'] are stored as
+MirroredEntity rows: the entity's JSON plus indexed copies of its Id, SyncToken,
+LastUpdatedTime, DisplayName and DocNumber. The mirror is fed by quickbooks.sync,
+so every sync (refresh_mirror, the qb_sync command, ...) keeps it current, and an
+entity Intuit notifies us has changed (see quickbooks.webhooks) is dropped, and
+its type refreshed on the next read. refresh_mirror writes the mirror in bulk; other calls
+to sync write it one entity at a time.
+
+Reads are served from the mirror as long as it is fresh enough:
+
+    invoices = entities(token, 'Invoice', max_age=300).filter(doc_number='1037')
+    customer = get_entity(token, 'Customer', '42')
+
+Anything older than `max_age` seconds (QUICKBOOKS['MIRROR_MAX_AGE'] by default) is
+brought up to date from Intuit first.
+"""
+import datetime
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import transaction
+from django.db.models.signals import pre_save
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import utc
+from .models import MirroredEntity, QuickbooksSyncState
+from .signals import qb_entity_changed, qb_entity_synced
+
+DEFAULT_MIRROR_MAX_AGE = 15 * 60
+
+# Rows written per bulk_create, and entity ids per delete.
+MIRROR_BATCH_SIZE = 500
+
+# A refresh that takes longer than this stops blocking other refreshes of the same type.
+MIRROR_REFRESH_LOCK_TIMEOUT = 10 * 60
+
+_local = threading.local()
+
+
+def mirrored_types():
+    return settings.QUICKBOOKS.get('MIRROR_TYPES', ())
+
+
+def refresh_mirror(token, entity_types=None, full=False, api=None):
+    """ Syncs `entity_types` (by default QUICKBOOKS['MIRROR_TYPES']) into the mirror and
+        returns the counts from quickbooks.sync.sync. Rows are committed a batch at a time,
+        and each type's rows are all written before its watermark moves, so an interrupted
+        refresh leaves the mirror consistent and the type is synced again next time.
+    """
+    # Imported here and in get_entity: quickbooks.models imports this module, and
+    # quickbooks.api (which quickbooks.sync uses) imports quickbooks.models.
+    from .sync import sync
+
+    entity_types = list(entity_types or mirrored_types())
+    writer = _MirrorWriter(token, entity_types)
+    # Not one transaction: that would hold its locks for as long as the sync pages through Intuit.
+    _local.writer = writer
+    try:
+        counts = sync(token, entity_types, full=full, api=api)
+    finally:
+        _local.writer = None
+    writer.flush()
+    return counts
+
+
+def entities(token, entity_type, max_age=None, api=None):
+    """ Returns a MirroredEntity queryset of `token`'s entities of `entity_type`, refreshed
+        first if the type was last synced more than `max_age` seconds ago. Use `.entity` on
+        a row for the entity itself.
+    """
+    if not _synced_within(token, entity_type, _max_age(max_age)):
+        cache = get_cache(settings.QUICKBOOKS.get('CACHE_ALIAS', 'default'))
+        lock = 'quickbooks:mirror:refreshing:{}:{}'.format(token.pk, entity_type)
+        # If someone else is already refreshing this type, serve what is there.
+        if cache.add(lock, True, MIRROR_REFRESH_LOCK_TIMEOUT):
+            try:
+                refresh_mirror(token, [entity_type], api=api)
+            finally:
+                cache.delete(lock)
+    return MirroredEntity.objects.filter(token=token, entity_type=entity_type)
+
+
+def get_entity(token, entity_type, entity_id, max_age=None, api=None):
+    """ Returns one entity, from the mirror if it is no older than `max_age` seconds or
+        read from Intuit (and mirrored) otherwise.
+    """
+    from .api import QuickbooksApi
+
+    max_age = _max_age(max_age)
+    try:
+        row = MirroredEntity.objects.get(token=token, entity_type=entity_type, entity_id=str(entity_id))
+    except MirroredEntity.DoesNotExist:
+        row = None
+    if row is not None and (_age_seconds(row.mirrored_at) <= max_age or _synced_within(token, entity_type, max_age)):
+        return row.entity
+
+    entity = (api or QuickbooksApi(token)).read(entity_type, entity_id).get(entity_type)
+    if entity is not None:
+        writer = _MirrorWriter(token, [entity_type])
+        writer.add(entity_type, entity, False)
+        writer.flush()
+    return entity
+
+
+class _MirrorWriter(object):
+    """ Collects synced entities and writes them in bulk. """
+    def __init__(self, token, entity_types):
+        self.token = token
+        self.entity_types = set(entity_types)
+        self.pending = OrderedDict()
+
+    def add(self, entity_type, entity, deleted):
+        self.pending[(entity_type, entity['Id'])] = None if deleted else entity
+        if len(self.pending) >= MIRROR_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """ Replaces the rows for every pending entity. There is no bulk update in this Django,
+            so the old rows are deleted and the new ones bulk created, in one transaction.
+        """
+        pending, self.pending = self.pending, OrderedDict()
+        ids_by_type = OrderedDict()
+        for entity_type, entity_id in pending:
+            ids_by_type.setdefault(entity_type, []).append(entity_id)
+
+        now = timezone.now()
+        with _atomic():
+            for entity_type, entity_ids in ids_by_type.items():
+                for start in range(0, len(entity_ids), MIRROR_BATCH_SIZE):
+                    MirroredEntity.objects.filter(token=self.token, entity_type=entity_type,
+                                                  entity_id__in=entity_ids[start:start + MIRROR_BATCH_SIZE]).delete()
+            MirroredEntity.objects.bulk_create(
+                [_mirror_row(self.token, entity_type, entity, now)
+                 for (entity_type, entity_id), entity in pending.items() if entity is not None],
+                batch_size=MIRROR_BATCH_SIZE)
+
+
+def _mirror_row(token, entity_type, entity, mirrored_at):
+    last_updated = parse_datetime(entity.get('MetaData', {}).get('LastUpdatedTime') or '')
+    if last_updated is not None and last_updated.tzinfo is not None:
+        last_updated = last_updated.astimezone(utc)
+        if not settings.USE_TZ:
+            last_updated = last_updated.replace(tzinfo=None)
+    return MirroredEntity(
+        token=token, entity_type=entity_type, entity_id=entity['Id'], sync_token=entity.get('SyncToken', ''),
+        last_updated=last_updated,
+        display_name=(entity.get('DisplayName') or entity.get('Name') or '')[:255],
+        doc_number=(entity.get('DocNumber') or '')[:64],
+        data=json.dumps(entity), mirrored_at=mirrored_at)
+
+
+def _synced_within(token, entity_type, max_age):
+    try:
+        state = QuickbooksSyncState.objects.get(token=token, entity_type=entity_type)
+    except QuickbooksSyncState.DoesNotExist:
+        return False
+    last_synced = state.last_synced
+    if last_synced is None or state.stale:
+        return False
+    if last_synced.tzinfo is None:
+        # sync stores naive UTC when USE_TZ is off.
+        last_synced = last_synced.replace(tzinfo=utc)
+    return (datetime.datetime.utcnow().replace(tzinfo=utc) - last_synced).total_seconds() <= max_age
+
+
+def _age_seconds(value):
+    return (timezone.now() - value).total_seconds()
+
+
+def _max_age(max_age):
+    return settings.QUICKBOOKS.get('MIRROR_MAX_AGE', DEFAULT_MIRROR_MAX_AGE) if max_age is None else max_age
+
+
+def _atomic():
+    # transaction.atomic is new in Django 1.6.
+    return (getattr(transaction, 'atomic', None) or transaction.commit_on_success)()
+
+
+def _mirror_synced_entity(sender, token, entity_type, entity, deleted, **kwargs):
+    writer = getattr(_local, 'writer', None)
+    if writer is not None and writer.token.pk == token.pk and entity_type in writer.entity_types:
+        writer.add(entity_type, entity, deleted)
+    elif entity_type in mirrored_types():
+        writer = _MirrorWriter(token, [entity_type])
+        writer.add(entity_type, entity, deleted)
+        writer.flush()
+
+
+def _finish_synced_type(sender, instance, **kwargs):
+    """ Writes a type's rows before quickbooks.sync saves its new watermark. """
+    writer = getattr(_local, 'writer', None)
+    if writer is not None and writer.token.pk == instance.token_id and instance.entity_type in writer.entity_types:
+        writer.flush()
+        instance.stale = False
+
+
+def _drop_changed_entity(sender, token, entity_type, entity_id, **kwargs):
+    MirroredEntity.objects.filter(token=token, entity_type=entity_type, entity_id=entity_id).delete()
+    # Otherwise entities() would keep serving the type without it until the watermark ages.
+    QuickbooksSyncState.objects.filter(token=token, entity_type=entity_type).update(stale=True)
+
+
+qb_entity_synced.connect(_mirror_synced_entity, dispatch_uid='quickbooks.mirror.qb_entity_synced')
+pre_save.connect(_finish_synced_type, sender=QuickbooksSyncState, dispatch_uid='quickbooks.mirror.pre_save')
+qb_entity_changed.connect(_drop_changed_entity, dispatch_uid='quickbooks.mirror.qb_entity_changed')
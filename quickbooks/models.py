@@ -1,6 +1,36 @@
+import datetime
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import get_cache
 from django.db import models
+from django.db.models.signals import post_delete, post_save
 from django.contrib.auth.models import User
+from django.utils import timezone
 from django_extensions.db.fields.encrypted import EncryptedCharField
+from .signals import qb_connected
+
+# Looking a token up means a query plus decrypting its fields, so the tokens of the last
+# QUICKBOOKS['TOKEN_CACHE_SIZE'] users are kept in each process for up to
+# QUICKBOOKS['TOKEN_CACHE_TTL'] seconds. Each entry is tagged with a version kept in the
+# shared cache, which saving or deleting a token resets, so every process drops it at once.
+# Only the version is shared; the decrypted credentials never leave the process.
+DEFAULT_TOKEN_CACHE_TTL = 60
+DEFAULT_TOKEN_CACHE_SIZE = 1000
+
+# Intuit's OAuth 1.0a access tokens are good for 180 days.
+TOKEN_LIFETIME = datetime.timedelta(days=180)
+
+# last_used_at is written at most once every QUICKBOOKS['TOKEN_TOUCH_INTERVAL'] seconds per token and process.
+DEFAULT_TOKEN_TOUCH_INTERVAL = 15 * 60
+
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+_token_touches = {}
 
 
 class QuickbooksToken(models.Model):
@@ -9,23 +39,134 @@ class QuickbooksToken(models.Model):
     access_token_secret = EncryptedCharField(max_length=255)
     realm_id = models.CharField(max_length=64)
     data_source = models.CharField(max_length=10)
+    # Unknown (null) for tokens issued before these fields were added.
+    issued_at = models.DateTimeField(null=True)
+    expires_at = models.DateTimeField(null=True, db_index=True)
+    last_used_at = models.DateTimeField(null=True)
+    # Cleared once Intuit has rejected the token (see quickbooks.health).
+    is_active = models.BooleanField(default=True)
+
+    def set_issued(self, issued_at=None):
+        self.issued_at = issued_at or timezone.now()
+        self.expires_at = self.issued_at + TOKEN_LIFETIME
+
+
+class QuickbooksSyncState(models.Model):
+    """ How far each entity type of a token's realm has been synced (see quickbooks.sync). """
+    token = models.ForeignKey(QuickbooksToken)
+    entity_type = models.CharField(max_length=64)
+    last_synced = models.DateTimeField(null=True)
+    # Set when Intuit reports a change to one of the type's entities (see quickbooks.mirror).
+    stale = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (('token', 'entity_type'),)
+
+
+class MirroredEntity(models.Model):
+    """ A local copy of one entity, kept by quickbooks.mirror. `data` holds the entity's JSON;
+        the other fields are indexed copies of the values it is usually looked up by.
+    """
+    token = models.ForeignKey(QuickbooksToken)
+    entity_type = models.CharField(max_length=64)
+    entity_id = models.CharField(max_length=64)
+    sync_token = models.CharField(max_length=32)
+    last_updated = models.DateTimeField(null=True, db_index=True)
+    display_name = models.CharField(max_length=255, blank=True, db_index=True)
+    doc_number = models.CharField(max_length=64, blank=True, db_index=True)
+    data = models.TextField()
+    mirrored_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('token', 'entity_type', 'entity_id'),)
+
+    @property
+    def entity(self):
+        return json.loads(self.data)
 
 
 class MissingTokenException(Exception):
     pass
 
 
+def token_for_user(user):
+    """ Returns the user's active token, or None if they have none. """
+    now = time.time()
+    version = _token_version(user.pk)
+    with _token_cache_lock:
+        entry = _token_cache.get(user.pk)
+        if entry is not None and entry[0] > now and entry[1] == version:
+            return entry[2]
+    try:
+        token = QuickbooksToken.objects.filter(user=user, is_active=True)[0]
+    except IndexError:
+        # Not cached: the user may be connecting in another process right now.
+        return None
+    with _token_cache_lock:
+        _token_cache.pop(user.pk, None)
+        _token_cache[user.pk] = (now + settings.QUICKBOOKS.get('TOKEN_CACHE_TTL', DEFAULT_TOKEN_CACHE_TTL), version,
+                                 token)
+        while len(_token_cache) > settings.QUICKBOOKS.get('TOKEN_CACHE_SIZE', DEFAULT_TOKEN_CACHE_SIZE):
+            _token_cache.popitem(last=False)
+    return token
+
+
+def invalidate_token_cache(user_id=None):
+    """ Drops the cached token of `user_id` in every process, or every cached token in this one. """
+    with _token_cache_lock:
+        if user_id is None:
+            _token_cache.clear()
+        else:
+            _token_cache.pop(user_id, None)
+    if user_id is not None:
+        _shared_cache().delete(_token_version_key(user_id))
+
+
+def _token_version(user_id):
+    cache = _shared_cache()
+    key = _token_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def _token_version_key(user_id):
+    return 'quickbooks:token-version:{}'.format(user_id)
+
+
+def _shared_cache():
+    return get_cache(settings.QUICKBOOKS.get('CACHE_ALIAS', 'default'))
+
+
+def touch_token(token):
+    """ Records that `token` is in use. """
+    if token.pk is None:
+        return
+    now = time.time()
+    if _token_touches.get(token.pk, 0) > now:
+        return
+    _token_touches[token.pk] = now + settings.QUICKBOOKS.get('TOKEN_TOUCH_INTERVAL', DEFAULT_TOKEN_TOUCH_INTERVAL)
+    token.last_used_at = timezone.now()
+    QuickbooksToken.objects.filter(pk=token.pk).update(last_used_at=token.last_used_at)
+
+
 def find_quickbooks_token(request_or_user):
     if isinstance(request_or_user, User):
         user = request_or_user
+        request = None
     else:
-        user = request_or_user.user
+        request = request_or_user
+        if hasattr(request, '_quickbooks_token'):
+            return request._quickbooks_token
+        user = request.user
     if not user.is_authenticated():
         return None
-    try:
-        return QuickbooksToken.objects.filter(user=user)[0]
-    except IndexError:
-        return None
+    token = token_for_user(user)
+    if request is not None:
+        request._quickbooks_token = token
+    return token
 
 
 def get_quickbooks_token(request):
@@ -33,3 +174,17 @@ def get_quickbooks_token(request):
     if token is None:
         raise MissingTokenException("No QuickBooks OAuth token exists for this user")
     return token
+
+
+def _invalidate_token(sender, token=None, instance=None, **kwargs):
+    invalidate_token_cache((token or instance).user_id)
+
+
+post_save.connect(_invalidate_token, sender=QuickbooksToken, dispatch_uid='quickbooks.models.post_save')
+post_delete.connect(_invalidate_token, sender=QuickbooksToken, dispatch_uid='quickbooks.models.post_delete')
+qb_connected.connect(_invalidate_token, dispatch_uid='quickbooks.models.qb_connected')
+
+if settings.QUICKBOOKS.get('MIRROR_TYPES'):
+    # Connects the mirror's receivers, so every sync and webhook keeps it current. Not `from .
+    # import mirror`, which fails when quickbooks.mirror is the module being imported first.
+    import quickbooks.mirror  # noqa
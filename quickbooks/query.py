@@ -0,0 +1,162 @@
+"""
+A small Django-ORM-like builder for the v3 query language.
+
+    api.objects('Invoice').filter(TxnDate__gte=date(2014, 1, 1), CustomerRef='24') \\
+        .only('Id', 'TotalAmt').order_by('-TxnDate')[:50]
+
+compiles to
+
+    select Id, TotalAmt from Invoice where CustomerRef = '24' and TxnDate >= '2014-01-01'
+    orderby TxnDate desc
+
+and is only sent when iterated, with paging (STARTPOSITION/MAXRESULTS) worked out
+from the slice. Nested fields are spelled with double underscores, as in Django:
+MetaData__LastUpdatedTime__gt. The query language has no OR, so neither does this.
+"""
+import datetime
+import numbers
+
+OPERATORS = {
+    'exact': '=',
+    'gt': '>',
+    'gte': '>=',
+    'lt': '<',
+    'lte': '<=',
+    'in': 'IN',
+    'like': 'LIKE',
+    'startswith': 'LIKE',
+    'endswith': 'LIKE',
+    'contains': 'LIKE',
+}
+
+LIKE_PATTERNS = {
+    'startswith': u'{}%',
+    'endswith': u'%{}',
+    'contains': u'%{}%',
+}
+
+
+def format_timestamp(value):
+    """ Formats a datetime the way the v3 api expects. Naive datetimes are taken to be UTC. """
+    if not isinstance(value, datetime.datetime):
+        return value
+    if value.tzinfo is None:
+        return value.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+    return value.isoformat()
+
+
+def quote(value):
+    """ Renders a Python value as a query language literal. Byte strings are taken to be UTF-8. """
+    if value is None:
+        raise ValueError("The query language has no null, so None can't be used as a value")
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime.datetime):
+        value = format_timestamp(value)
+    elif isinstance(value, datetime.date):
+        value = value.isoformat()
+    elif isinstance(value, numbers.Number):
+        value = str(value)
+    value = _text(value)
+    return u"'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def compile_lookup(lookup, value):
+    """ Compiles one filter() keyword argument, e.g. TxnDate__gte, into a condition. """
+    parts = lookup.split('__')
+    operation = parts.pop() if len(parts) > 1 and parts[-1] in OPERATORS else 'exact'
+    field = '.'.join(parts)
+
+    if operation == 'in':
+        return u'{} IN ({})'.format(field, ', '.join(quote(item) for item in value))
+    if operation in LIKE_PATTERNS:
+        value = LIKE_PATTERNS[operation].format(_text(value))
+    return u'{} {} {}'.format(field, OPERATORS[operation], quote(value))
+
+
+class QuerySet(object):
+    """ A lazy query for one object type. Every method returns a new QuerySet. """
+    def __init__(self, api, object_type):
+        self.api = api
+        self.object_type = object_type
+        self._conditions = ()
+        self._fields = None
+        self._ordering = ()
+        self._start = 0
+        self._stop = None
+        self._typed = False
+
+    def filter(self, **lookups):
+        conditions = tuple(compile_lookup(lookup, lookups[lookup]) for lookup in sorted(lookups))
+        return self._clone(_conditions=self._conditions + conditions)
+
+    def only(self, *fields):
+        """ Asks the server for just these fields. """
+        return self._clone(_fields=tuple(field.replace('__', '.') for field in fields))
+
+    def order_by(self, *fields):
+        ordering = tuple('{} desc'.format(field[1:]) if field.startswith('-') else field for field in fields)
+        return self._clone(_ordering=tuple(field.replace('__', '.') for field in ordering))
+
+    def typed(self):
+        """ Yields quickbooks.entities objects instead of dicts. """
+        return self._clone(_typed=True)
+
+    def compile(self, count=False):
+        """ Returns the query string, without paging. """
+        if count:
+            selection = 'count(*)'
+        else:
+            selection = ', '.join(self._fields) if self._fields else '*'
+        query = u'select {} from {}'.format(selection, self.object_type)
+        if self._conditions:
+            query += u' where ' + u' and '.join(self._conditions)
+        if self._ordering and not count:
+            query += u' orderby ' + ', '.join(self._ordering)
+        return query
+
+    def count(self):
+        response = self.api.query(self.compile(count=True))
+        return response.get('QueryResponse', {}).get('totalCount', 0)
+
+    def first(self):
+        for entity in self[:1]:
+            return entity
+        return None
+
+    def __iter__(self):
+        limit = None if self._stop is None else self._stop - self._start
+        if limit == 0:
+            return iter(())
+        return self.api.query_iter(self.compile(), start_position=self._start + 1, limit=limit, typed=self._typed)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError("QuerySet slices cannot have a step")
+            if (key.start or 0) < 0 or (key.stop is not None and key.stop < 0):
+                raise ValueError("QuerySet slices cannot be negative")
+            start = self._start + (key.start or 0)
+            stop = self._stop
+            if key.stop is not None:
+                stop = self._start + key.stop if stop is None else min(stop, self._start + key.stop)
+            return self._clone(_start=start, _stop=max(start, stop) if stop is not None else None)
+
+        if key < 0:
+            raise ValueError("QuerySets cannot be indexed from the end")
+        for entity in self[key:key + 1]:
+            return entity
+        raise IndexError("QuerySet index out of range")
+
+    def __repr__(self):
+        return '<QuerySet {}>'.format(self.compile().encode('utf-8'))
+
+    def _clone(self, **changes):
+        clone = QuerySet(self.api, self.object_type)
+        clone.__dict__.update(self.__dict__)
+        clone.__dict__.update(changes)
+        return clone
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, str) else value
@@ -0,0 +1,89 @@
+"""
+Process-wide registry of OAuth1Sessions, so TCP/TLS connections to Intuit are reused
+across QuickbooksApi instances instead of being set up for every one.
+
+Sessions are keyed by realm and access token. Entries idle for longer than
+QUICKBOOKS['SESSION_IDLE_TIMEOUT'] seconds are closed the next time the registry is
+used, and every entry for a realm is dropped when one of its tokens is deleted,
+connected again, renewed or rejected.
+"""
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1Session
+from django.conf import settings
+from django.db.models.signals import post_delete
+from .models import QuickbooksToken
+from .signals import qb_connected, qb_token_dead, qb_token_reconnected
+
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_IDLE_TIMEOUT = 300
+
+
+class SessionPool(object):
+    def __init__(self, pool_connections=None, pool_maxsize=None, idle_timeout=None):
+        options = settings.QUICKBOOKS
+        self.pool_connections = pool_connections or options.get('SESSION_POOL_CONNECTIONS', DEFAULT_POOL_CONNECTIONS)
+        self.pool_maxsize = pool_maxsize or options.get('SESSION_POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE)
+        self.idle_timeout = idle_timeout or options.get('SESSION_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """ Returns the shared session for `token`, creating it if needed. """
+        key = (token.realm_id, token.access_token)
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._sessions.get(key)
+            if entry is None:
+                entry = self._sessions[key] = [self._create_session(token), now]
+            entry[1] = now
+            return entry[0]
+
+    def discard_realm(self, realm_id):
+        """ Closes and forgets every session for `realm_id`. """
+        with self._lock:
+            for key in [key for key in self._sessions if key[0] == realm_id]:
+                self._sessions.pop(key)[0].close()
+
+    def clear(self):
+        with self._lock:
+            for session, last_used in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def _evict_idle(self, now):
+        for key, (session, last_used) in list(self._sessions.items()):
+            if now - last_used > self.idle_timeout:
+                del self._sessions[key]
+                session.close()
+
+    def _create_session(self, token):
+        session = OAuth1Session(client_key=settings.QUICKBOOKS['CONSUMER_KEY'],
+                                client_secret=settings.QUICKBOOKS['CONSUMER_SECRET'],
+                                resource_owner_key=token.access_token,
+                                resource_owner_secret=token.access_token_secret)
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'content-type': 'application/json',
+                                'accept': 'application/json',
+                                'connection': 'keep-alive'})
+        return session
+
+
+session_pool = SessionPool()
+
+
+def _discard_token_sessions(sender, token=None, instance=None, **kwargs):
+    token = token or instance
+    session_pool.discard_realm(token.realm_id)
+
+
+post_delete.connect(_discard_token_sessions, sender=QuickbooksToken, dispatch_uid='quickbooks.sessions.post_delete')
+qb_connected.connect(_discard_token_sessions, dispatch_uid='quickbooks.sessions.qb_connected')
+qb_token_reconnected.connect(_discard_token_sessions, dispatch_uid='quickbooks.sessions.qb_token_reconnected')
+qb_token_dead.connect(_discard_token_sessions, dispatch_uid='quickbooks.sessions.qb_token_dead')
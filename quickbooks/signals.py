@@ -1,3 +1,18 @@
 import django.dispatch
 
 qb_connected = django.dispatch.Signal(providing_args=['token'])
+
+# Sent by quickbooks.health when a token has been renewed, or found to be rejected by Intuit.
+qb_token_reconnected = django.dispatch.Signal(providing_args=['token'])
+qb_token_dead = django.dispatch.Signal(providing_args=['token', 'reason'])
+
+# Sent by quickbooks.sync for every new, changed or deleted entity it finds.
+qb_entity_synced = django.dispatch.Signal(providing_args=['token', 'entity_type', 'entity', 'deleted'])
+
+# Sent by quickbooks.webhooks for every entity change Intuit notifies us about.
+qb_entity_changed = django.dispatch.Signal(providing_args=['token', 'entity_type', 'entity_id', 'operation',
+                                                           'last_updated'])
+
+# Sent around every request QuickbooksApi makes (see quickbooks.instrumentation).
+qb_pre_request = django.dispatch.Signal(providing_args=['realm_id', 'method', 'url', 'operation', 'object_type'])
+qb_post_request = django.dispatch.Signal(providing_args=['metric'])
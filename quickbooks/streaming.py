@@ -0,0 +1,130 @@
+"""
+Incremental decoding of v3 query responses.
+
+response.json() reads the whole body and builds every entity before returning
+any of them. iter_query_entities instead walks the response a chunk at a time
+and yields each entity in QueryResponse.<Entity> as soon as it has been read, so
+no more than one entity (plus one chunk) is held in memory at once.
+
+This module doesn't depend on Django, so it can be used and tested on its own.
+"""
+import codecs
+import json
+import re
+
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+
+_decoder = json.JSONDecoder()
+
+
+def iter_query_entities(chunks, fault_error=None):
+    """ Yields the entities of a query response read from `chunks`, an iterable of bytes
+        such as response.iter_content(). The paging metadata and any other keys are skipped.
+
+        If the response turns out to be a Fault, `fault_error(fault)` is raised, or a
+        ValueError if no fault_error is given.
+    """
+    reader = _Reader(chunks)
+    reader.expect('{')
+    for key in reader.object_keys():
+        if key == 'QueryResponse':
+            reader.expect('{')
+            for entity_key in reader.object_keys():
+                if reader.peek() == '[':
+                    for entity in reader.array_values():
+                        yield entity
+                else:
+                    reader.value()
+        elif key == 'Fault':
+            fault = reader.value()
+            raise fault_error(fault) if fault_error else ValueError("Query failed: {!r}".format(fault))
+        else:
+            reader.value()
+
+
+class _Reader(object):
+    """ Just enough of a pull parser to walk objects and arrays, decoding the values
+        inside them with json.JSONDecoder.raw_decode.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = u''
+        self.position = 0
+        self.exhausted = False
+
+    def read_more(self):
+        """ Appends the next chunk to the buffer, dropping what has already been parsed.
+            Returns False at the end of the response.
+        """
+        if self.exhausted:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.exhausted = True
+            chunk = b''
+        text = self.text_decoder.decode(chunk, final=self.exhausted)
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+        return True
+
+    def peek(self):
+        """ Returns the next non-whitespace character without consuming it. """
+        while True:
+            self.position = WHITESPACE_RE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read_more():
+                raise ValueError("Unexpected end of JSON response")
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError("Expected {!r} at {!r}".format(character, self.buffer[self.position:self.position + 20]))
+        self.position += 1
+
+    def value(self):
+        """ Decodes and consumes the next complete JSON value. """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                # Most likely the value runs past the end of the buffer.
+                if self.read_more():
+                    continue
+                raise
+            # A number that ends the buffer may continue in the next chunk.
+            if end == len(self.buffer) and self.read_more():
+                continue
+            self.position = end
+            return value
+
+    def object_keys(self):
+        """ Yields the keys of the object whose '{' was just consumed. The caller must consume
+            each key's value before asking for the next key.
+        """
+        if self.peek() == '}':
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == '}':
+                self.position += 1
+                return
+            self.expect(',')
+
+    def array_values(self):
+        """ Consumes the next array, yielding its values one at a time. """
+        self.expect('[')
+        if self.peek() == ']':
+            self.position += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ']':
+                self.position += 1
+                return
+            self.expect(',')
@@ -0,0 +1,113 @@
+"""
+Incremental sync: hands over only the entities that changed since the last run.
+
+How far each entity type has been synced is kept per token in QuickbooksSyncState.
+Types synced within the last 30 days are brought up to date with a single
+ChangeDataCapture call, which also reports deletions. Anything else (first runs,
+stale watermarks, CDC responses that hit their 1000 entity cap) falls back to
+querying on MetaData.LastUpdatedTime, which cannot see deletions.
+
+Every entity found is passed to the callback, if one is given, and sent as the
+qb_entity_synced signal. The same entity may be delivered more than once, so
+receivers should be idempotent.
+"""
+import datetime
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import utc
+from .api import CDC_MAX_AGE, MAX_QUERY_PAGE_SIZE, QuickbooksApi, cdc_changes, format_timestamp
+from .models import QuickbooksSyncState
+from .signals import qb_entity_synced
+
+DEFAULT_SYNC_TYPES = ('Account', 'Bill', 'Customer', 'Invoice', 'Item', 'Payment', 'Vendor')
+
+# CDC returns at most this many entities per type.
+CDC_MAX_RESULTS = 1000
+
+# Queries run against our clock rather than Intuit's, so the next watermark is moved back
+# a little to allow for skew between the two.
+CLOCK_SKEW_ALLOWANCE = datetime.timedelta(minutes=5)
+
+
+def sync(token, entity_types=DEFAULT_SYNC_TYPES, callback=None, full=False, api=None):
+    """ Syncs `entity_types` for `token` and returns a dict of entity type -> entities delivered.
+
+        `callback(token, entity_type, entity, deleted)` is called for every entity found.
+        `full` ignores the stored watermarks and walks every entity.
+    """
+    api = api or QuickbooksApi(token)
+    states = dict((state.entity_type, state)
+                  for state in QuickbooksSyncState.objects.filter(token=token, entity_type__in=entity_types))
+    for entity_type in entity_types:
+        if entity_type not in states:
+            states[entity_type] = QuickbooksSyncState(token=token, entity_type=entity_type)
+
+    def deliver(entity_type, entity):
+        deleted = entity.get('status') == 'Deleted'
+        if callback is not None:
+            callback(token, entity_type, entity, deleted)
+        qb_entity_synced.send(sender=None, token=token, entity_type=entity_type, entity=entity, deleted=deleted)
+
+    now = _utcnow()
+    if full:
+        cdc_types = []
+    else:
+        cdc_types = [entity_type for entity_type in entity_types
+                     if states[entity_type].last_synced is not None and
+                     now - _aware(states[entity_type].last_synced) < CDC_MAX_AGE]
+    query_types = [entity_type for entity_type in entity_types if entity_type not in cdc_types]
+    counts = dict((entity_type, 0) for entity_type in entity_types)
+
+    if cdc_types:
+        # One call covers every type, so ask from the oldest watermark; types that were
+        # synced more recently may see a few entities again.
+        changed_since = min(_aware(states[entity_type].last_synced) for entity_type in cdc_types)
+        response = api.cdc(cdc_types, changed_since)
+        changes = cdc_changes(response)
+        synced_at = parse_datetime(response['time']) if response.get('time') else now - CLOCK_SKEW_ALLOWANCE
+
+        for entity_type in cdc_types:
+            entities = changes.get(entity_type, [])
+            if len(entities) >= CDC_MAX_RESULTS:
+                # Truncated; the query below picks up everything we missed.
+                query_types.append(entity_type)
+                continue
+            for entity in entities:
+                deliver(entity_type, entity)
+            counts[entity_type] += len(entities)
+            _save_state(states[entity_type], synced_at)
+
+    for entity_type in query_types:
+        synced_at = _utcnow() - CLOCK_SKEW_ALLOWANCE
+        query = "select * from {}".format(entity_type)
+        last_synced = None if full else states[entity_type].last_synced
+        if last_synced is not None:
+            query += " where MetaData.LastUpdatedTime > '{}'".format(format_timestamp(_aware(last_synced)))
+        # Paging is only stable in a fixed order, and a skipped entity would never be synced.
+        query += " orderby Id"
+        for entity in api.query_iter(query, page_size=MAX_QUERY_PAGE_SIZE):
+            deliver(entity_type, entity)
+            counts[entity_type] += 1
+        _save_state(states[entity_type], synced_at)
+
+    return counts
+
+
+def _save_state(state, synced_at):
+    synced_at = synced_at.astimezone(utc)
+    if not settings.USE_TZ:
+        # Stored as naive UTC, which is how _aware and format_timestamp read it back.
+        synced_at = synced_at.replace(tzinfo=None)
+    state.last_synced = synced_at
+    state.save()
+
+
+def _aware(value):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=utc)
+    return value
+
+
+def _utcnow():
+    return datetime.datetime.utcnow().replace(tzinfo=utc)
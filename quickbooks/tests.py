@@ -1,3 +1,494 @@
+import datetime
+import json
+import tempfile
+
+from concurrent.futures import Future
+from django.conf import settings
+
+if not settings.configured:
+    # Outside a project (plain nosetests), configure just enough to import the app.
+    from keyczar import keyczart
+
+    _keys_dir = tempfile.mkdtemp()
+    keyczart.main(['create', '--location=' + _keys_dir, '--purpose=crypt'])
+    keyczart.main(['addkey', '--location=' + _keys_dir, '--status=primary'])
+    settings.configure(
+        INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes', 'quickbooks'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        ENCRYPTED_FIELD_KEYS_DIR=_keys_dir,
+        QUICKBOOKS={'CONSUMER_KEY': 'key', 'CONSUMER_SECRET': 'secret'},
+    )
+
+from quickbooks.entities import Invoice, Ref, dump, load  # noqa: E402
+from quickbooks.query import QuerySet  # noqa: E402
+from quickbooks.streaming import iter_query_entities  # noqa: E402
+
+
 # Let's start with a simple passing test.
 def test():
     assert True
+
+
+INVOICE = {
+    'Id': '130',
+    'SyncToken': '2',
+    'DocNumber': '1037',
+    'TotalAmt': 362.07,
+    'CustomerRef': {'value': '24', 'name': 'Sonnenschein Family Store'},
+    'Line': [{'Id': '1', 'Amount': 362.07, 'DetailType': 'SalesItemLineDetail',
+              'SalesItemLineDetail': {'ItemRef': {'value': '5', 'name': 'Rock Fountain'}}}],
+    'MetaData': {'CreateTime': '2014-09-19T13:16:17-07:00'},
+    'CustomerFieldNobodyModeled': {'value': 'kept'},
+}
+
+
+def test_entity_round_trip():
+    invoice = load('Invoice', INVOICE)
+    assert isinstance(invoice, Invoice)
+    assert invoice.to_dict() == INVOICE
+    assert json.loads(dump(invoice)) == INVOICE
+
+
+def test_entity_nested_values_are_decoded_lazily():
+    invoice = load('Invoice', INVOICE)
+    assert isinstance(invoice._Line, str)
+    assert invoice.Line[0]['Amount'] == 362.07
+    assert invoice.CustomerRef == Ref('24', 'Sonnenschein Family Store')
+
+    invoice.CustomerRef = Ref('25')
+    assert invoice.to_dict()['CustomerRef'] == {'value': '25'}
+
+
+def test_unknown_entity_types_stay_dicts():
+    assert load('JournalEntry', {'Id': '1'}) == {'Id': '1'}
+
+
+class FakeApi(object):
+    def __init__(self, entities):
+        self.entities = entities
+        self.calls = []
+
+    def query_iter(self, query, start_position=1, limit=None, typed=False):
+        self.calls.append((query, start_position, limit))
+        end = None if limit is None else start_position - 1 + limit
+        return iter(self.entities[start_position - 1:end])
+
+
+def test_query_compiles_filters_projection_and_ordering():
+    invoices = QuerySet(FakeApi([]), 'Invoice')
+    query = invoices.filter(TxnDate__gte=datetime.date(2014, 1, 1), CustomerRef="Amy's") \
+        .filter(MetaData__LastUpdatedTime__gt=datetime.datetime(2014, 2, 3, 4, 5, 6), Id__in=['1', 2]) \
+        .only('Id', 'TotalAmt').order_by('-TxnDate')
+    assert query.compile() == (
+        "select Id, TotalAmt from Invoice where CustomerRef = 'Amy\\'s' and TxnDate >= '2014-01-01' "
+        "and Id IN ('1', '2') and MetaData.LastUpdatedTime > '2014-02-03T04:05:06+00:00' orderby TxnDate desc")
+    assert invoices.filter(DisplayName__startswith='Am').compile() == \
+        "select * from Invoice where DisplayName LIKE 'Am%'"
+    assert invoices.filter(DisplayName__startswith='Caf\xc3\xa9').compile() == \
+        u"select * from Invoice where DisplayName LIKE 'Caf\xe9%'"
+    try:
+        invoices.filter(CustomerRef=None)
+    except ValueError:
+        pass
+    else:
+        assert False, "None was compiled"
+
+
+def test_query_slices_become_paging():
+    api = FakeApi(list(range(10)))
+    invoices = QuerySet(api, 'Invoice')
+    assert list(invoices[2:8][1:3]) == [3, 4]
+    assert api.calls[-1][1:] == (4, 2)
+    assert invoices[5] == 5
+    assert list(invoices[3:3]) == []
+
+
+def _chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_streamed_query_entities_match_json_decoding():
+    invoices = [dict(INVOICE, Id=str(number), PrivateNote=u'Caf\xe9 \u2615 {}'.format(number)) for number in range(5)]
+    response = json.dumps({'time': '2014-09-19T13:16:17-07:00',
+                           'QueryResponse': {'startPosition': 1, 'Invoice': invoices, 'maxResults': 5}},
+                          ensure_ascii=False)
+    # Tiny chunks split keys, numbers and multi-byte characters.
+    for size in (1, 7, len(response)):
+        assert list(iter_query_entities(_chunked(response.encode('utf-8'), size))) == invoices
+    assert list(iter_query_entities([b'{"QueryResponse": {}, "time": "2014-09-19"}'])) == []
+
+
+def test_streamed_query_fault_is_raised():
+    response = json.dumps({'Fault': {'type': 'ValidationFault', 'Error': [{'code': '4000'}]}}).encode('utf-8')
+    try:
+        list(iter_query_entities(_chunked(response, 3), fault_error=lambda fault: KeyError(fault['type'])))
+    except KeyError as e:
+        assert e.args == ('ValidationFault',)
+    else:
+        assert False, "the fault wasn't raised"
+
+
+class ReplayingApi(object):
+    """ Applies creates like Intuit does, replaying the stored response for a repeated requestid.
+        `lose_responses` creates are applied but answered with a CommunicationError.
+    """
+    def __init__(self, lose_responses=0):
+        self.lose_responses = lose_responses
+        self.created = []
+        self.responses = {}
+
+    def create(self, object_type, object_body, request_id=None):
+        from quickbooks.api import CommunicationError
+
+        if request_id not in self.responses:
+            self.created.append(object_body)
+            self.responses[request_id] = {object_type: dict(object_body, Id=str(len(self.created)))}
+        if self.lose_responses:
+            self.lose_responses -= 1
+            raise CommunicationError('Connection reset by peer')
+        return self.responses[request_id]
+
+
+def test_write_queue_create_retried_after_lost_response_is_not_duplicated():
+    from quickbooks.api import CommunicationError
+    from quickbooks.writes import WriteQueue
+
+    api = ReplayingApi(lose_responses=1)
+    writes = WriteQueue(api)
+    writes.create('Invoice', {'DocNumber': 'A'}, key='order-A')
+    try:
+        writes.flush()
+    except CommunicationError:
+        pass
+    else:
+        assert False, "the lost response wasn't raised"
+
+    writes.create('Invoice', {'DocNumber': 'B'}, key='order-B')
+    results = writes.flush()
+    assert [(result.key, result.entity['Id']) for result in results] == [('order-A', '1'), ('order-B', '2')]
+    assert [body['DocNumber'] for body in api.created] == ['A', 'B']
+
+    # Another queue (say, after a restart) sending the same key gets the original back.
+    retried = WriteQueue(api)
+    retried.create('Invoice', {'DocNumber': 'A'}, key='order-A')
+    assert retried.flush()[0].entity['Id'] == '1'
+    assert len(api.created) == 2
+
+
+class ConflictingApi(object):
+    """ Answers the first update of each entity with a stale object fault. """
+    def __init__(self):
+        self.sync_tokens = {}
+        self.queries = []
+
+    def objects(self, object_type):
+        return QuerySet(self, object_type)
+
+    def query_iter(self, query, stream=False, **kwargs):
+        self.queries.append((query, stream))
+        ids = [part.strip("' ") for part in query.split('IN (')[1].split(')')[0].split(',')]
+        return iter([{'Id': entity_id, 'SyncToken': str(self.sync_tokens.get(entity_id, 0))} for entity_id in ids])
+
+    def batch(self, operations, request_id=None):
+        from quickbooks.api import BatchResult
+
+        results = []
+        for kind, object_type, body in operations:
+            entity_id = body['Id']
+            if entity_id not in self.sync_tokens:
+                # Someone else updated it since we read its SyncToken.
+                self.sync_tokens[entity_id] = 1
+                results.append(BatchResult(kind, object_type, None, {'Error': [{'code': '5010'}]}))
+            else:
+                assert body['SyncToken'] == str(self.sync_tokens[entity_id])
+                self.sync_tokens[entity_id] += 1
+                results.append(BatchResult(kind, object_type, dict(body, SyncToken=str(self.sync_tokens[entity_id])),
+                                           None))
+        return results
+
+
+def test_write_queue_rereads_sync_tokens_uncached_after_a_conflict():
+    from quickbooks.writes import SYNC_TOKEN_LOOKUP_SIZE, WriteQueue
+
+    api = ConflictingApi()
+    writes = WriteQueue(api)
+    for entity_id in range(SYNC_TOKEN_LOOKUP_SIZE + 1):
+        writes.update('Customer', entity_id, {'Notes': 'first'})
+        writes.update('Customer', entity_id, {'Active': True})
+    results = writes.flush()
+
+    assert all(result.ok for result in results) and len(results) == SYNC_TOKEN_LOOKUP_SIZE + 1
+    assert results[0].entity == {'Id': '0', 'SyncToken': '2', 'sparse': True, 'Notes': 'first', 'Active': True}
+    # Two lookups (one per chunk of ids) before the first attempt and two after the conflicts.
+    assert len(api.queries) == 4 and all(stream for query, stream in api.queries)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode('utf-8') if body is not None else b'<html>Bad Gateway</html>'
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def iter_content(self, chunk_size):
+        return iter(_chunked(self.content, chunk_size))
+
+    def close(self):
+        pass
+
+
+def _fault(code, fault_type='ValidationFault'):
+    return {'type': fault_type, 'Error': [{'code': code, 'Message': 'message', 'Detail': 'detail'}]}
+
+
+def test_fault_error_mapping():
+    from quickbooks import api
+
+    assert type(api.fault_error(_fault('3200'), 401)) is api.AuthenticationFailure
+    assert type(api.fault_error(None, 401)) is api.AuthenticationFailure
+    assert type(api.fault_error(_fault('3001', 'ThrottleExceeded'), 429)) is api.TryLaterError
+    assert type(api.fault_error(None, 503)) is api.TryLaterError
+    assert type(api.fault_error(_fault('6240'), 400)) is api.DuplicateItemError
+    assert type(api.fault_error(_fault('5010'), 400)) is api.StaleObjectError
+    error = api.fault_error(_fault('2020'), 400)
+    assert type(error) is api.ApiError and str(error) == 'message: detail' and error.fault == _fault('2020')
+
+    assert api.response_error(FakeResponse(200, {})) is None
+    assert type(api.response_error(FakeResponse(502))) is api.TryLaterError
+
+
+def test_retry_decisions():
+    from quickbooks import api
+
+    throttled = api.response_error(FakeResponse(429, {'Fault': _fault('3001', 'ThrottleExceeded')}))
+    unavailable = api.response_error(FakeResponse(503))
+    for error in (throttled, unavailable):
+        assert api.should_retry(error, idempotent=True) and api.should_retry(error, idempotent=False)
+
+    # The gateway may have passed the request on; only resend it if that's harmless.
+    for status in (502, 504):
+        error = api.response_error(FakeResponse(status))
+        assert api.should_retry(error, idempotent=True) and not api.should_retry(error, idempotent=False)
+
+    network = api.CommunicationError('Connection reset by peer')
+    assert api.should_retry(network, idempotent=True) and not api.should_retry(network, idempotent=False)
+    rejected = api.response_error(FakeResponse(400, {'Fault': _fault('2020')}))
+    assert not api.should_retry(rejected, idempotent=True)
+
+
+class FakeSession(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+        self.urls = []
+
+    def request(self, method, url, **kwargs):
+        self.requests += 1
+        self.urls.append(url)
+        return self.responses.pop(0)
+
+
+def test_request_retries_gateway_errors_only_when_idempotent():
+    from django.conf import settings
+    from quickbooks.api import QuickbooksApi, TryLaterError
+    from quickbooks.models import QuickbooksToken
+
+    api = QuickbooksApi(QuickbooksToken(access_token='token', access_token_secret='secret', realm_id='1',
+                                        data_source='QBO'))
+    backoff_base = settings.QUICKBOOKS.get('BACKOFF_BASE')
+    settings.QUICKBOOKS['BACKOFF_BASE'] = 0.001
+    try:
+        api.session = FakeSession([FakeResponse(504), FakeResponse(200, {'Customer': {'Id': '1'}})])
+        assert api.read('Customer', '1') == {'Customer': {'Id': '1'}}
+        assert api.session.requests == 2
+
+        api.session = FakeSession([FakeResponse(504), FakeResponse(200, {'Customer': {'Id': '1'}})])
+        try:
+            api.create('Customer', {'DisplayName': 'Amy'})
+        except TryLaterError:
+            assert api.session.requests == 1
+        else:
+            assert False, "the create was sent again"
+
+        api.session = FakeSession([FakeResponse(504), FakeResponse(200, {'Customer': {'Id': '1'}})])
+        assert api.create('Customer', {'DisplayName': 'Amy'}, request_id='amy')['Customer'] == {'Id': '1'}
+
+        api.session = FakeSession([FakeResponse(429, {'Fault': _fault('3001', 'ThrottleExceeded')}),
+                                   FakeResponse(200, {'Customer': {'Id': '2'}})])
+        assert api.create('Customer', {'DisplayName': 'Bo'})['Customer'] == {'Id': '2'}
+    finally:
+        if backoff_base is None:
+            settings.QUICKBOOKS.pop('BACKOFF_BASE')
+        else:
+            settings.QUICKBOOKS['BACKOFF_BASE'] = backoff_base
+
+
+def test_failing_signal_receivers_dont_break_requests():
+    from quickbooks.api import QuickbooksApi
+    from quickbooks.models import QuickbooksToken
+    from quickbooks.signals import qb_post_request, qb_pre_request
+
+    def fail(sender, **kwargs):
+        raise RuntimeError("receiver failed")
+
+    api = QuickbooksApi(QuickbooksToken(access_token='token', access_token_secret='secret', realm_id='1',
+                                        data_source='QBO'))
+    api.session = FakeSession([FakeResponse(200, {'Customer': {'Id': '1'}})])
+    qb_pre_request.connect(fail, dispatch_uid='quickbooks.tests.fail')
+    qb_post_request.connect(fail, dispatch_uid='quickbooks.tests.fail')
+    try:
+        assert api.read('Customer', '1') == {'Customer': {'Id': '1'}}
+    finally:
+        qb_pre_request.disconnect(dispatch_uid='quickbooks.tests.fail')
+        qb_post_request.disconnect(dispatch_uid='quickbooks.tests.fail')
+
+
+class PagingApi(object):
+    def __init__(self, pages):
+        self.pages = pages
+        self.queries = []
+
+    def query_pages(self, query, page_size, start_position, prefetch):
+        self.queries.append(query)
+        return iter(self.pages)
+
+
+def test_csv_export_reports_fields_missing_from_the_columns():
+    import csv
+    import shutil
+    from quickbooks.export import CSV, export_entities
+
+    pages = [[{'Id': '1', 'DisplayName': 'Amy'}], [{'Id': '2', 'DisplayName': 'Bo', 'Notes': 'Late payer'}]]
+    output_dir = tempfile.mkdtemp()
+    try:
+        api = PagingApi(pages)
+        stats = export_entities(api, ['Customer'], output_dir, format=CSV)
+        assert api.queries == ['select * from Customer orderby Id']
+        assert stats['Customer']['dropped_fields'] == ['Notes']
+
+        stats = export_entities(PagingApi(pages), ['Customer'], output_dir, format=CSV,
+                                columns=['Id', 'DisplayName', 'Notes'])
+        assert stats['Customer']['dropped_fields'] == []
+        with open(output_dir + '/Customer.csv') as output:
+            assert list(csv.reader(output)) == [['Id', 'DisplayName', 'Notes'], ['1', 'Amy', ''],
+                                                ['2', 'Bo', 'Late payer']]
+    finally:
+        shutil.rmtree(output_dir)
+
+
+class CancellingExecutor(object):
+    """ An executor that drops every call, like a pool shut down with its queue cancelled. """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.cancel()
+        return future
+
+
+def test_realm_limiter_frees_slots_of_cancelled_calls():
+    import threading
+    from concurrent.futures import CancelledError, ThreadPoolExecutor
+    from quickbooks.async_api import RealmLimiter
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    limiter = RealmLimiter(executor, 1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    running = limiter.submit(block)
+    started.wait()
+    queued = [limiter.submit(lambda: None) for _ in range(5000)]
+    for future in queued:
+        future.cancel()
+    release.set()
+    running.result(timeout=5)
+    assert limiter.submit(lambda: 'next').result(timeout=5) == 'next'
+    assert limiter._active == 0
+    executor.shutdown()
+
+    limiter = RealmLimiter(CancellingExecutor(), 1)
+    try:
+        limiter.submit(lambda: None).result(timeout=5)
+    except CancelledError:
+        pass
+    else:
+        assert False, "the dropped call succeeded"
+    assert limiter._active == 0
+
+
+def _notification(realm_id, *entities):
+    return {'eventNotifications': [{'realmId': realm_id, 'dataChangeEvent': {'entities': [
+        {'name': entity_type, 'id': entity_id, 'operation': 'Update', 'lastUpdated': '2015-10-05T14:42:19.000Z'}
+        for entity_type, entity_id in entities]}}]}
+
+
+def test_webhook_signature():
+    import base64
+    import hashlib
+    import hmac
+    from quickbooks.webhooks import verify_signature
+
+    body = json.dumps(_notification('1', ('Customer', '5')))
+    signature = base64.b64encode(hmac.new('verifier', body, hashlib.sha256).digest())
+    settings.QUICKBOOKS['WEBHOOK_VERIFIER_TOKEN'] = 'verifier'
+    try:
+        assert verify_signature(body, signature)
+        assert not verify_signature(body + ' ', signature)
+        assert not verify_signature(body, None)
+    finally:
+        del settings.QUICKBOOKS['WEBHOOK_VERIFIER_TOKEN']
+    assert not verify_signature(body, signature)
+
+
+def test_webhook_notification_events():
+    from quickbooks.webhooks import notification_events
+
+    payload = _notification('1', ('Customer', '5'), ('Invoice', '7'))
+    payload['eventNotifications'].append(_notification('2', ('Item', '9'))['eventNotifications'][0])
+    events = notification_events(payload)
+    assert [(event['realm_id'], event['entity_type'], event['entity_id']) for event in events] == [
+        ('1', 'Customer', '5'), ('1', 'Invoice', '7'), ('2', 'Item', '9')]
+    assert notification_events({}) == []
+
+
+class RecordingQueue(object):
+    def __init__(self):
+        self.events = []
+
+    def put(self, events):
+        self.events.extend(events)
+
+
+def test_webhook_repeats_are_dropped():
+    from quickbooks import webhooks
+
+    queue, webhooks._queue = webhooks._queue, RecordingQueue()
+    try:
+        assert len(webhooks.dispatch(_notification('dedup', ('Customer', '5'), ('Customer', '6')))) == 2
+        assert webhooks.dispatch(_notification('dedup', ('Customer', '5'))) == []
+        assert [event['entity_id'] for event in webhooks._queue.events] == ['5', '6']
+    finally:
+        webhooks._queue = queue
+
+
+def test_queryset_filtered_on_a_non_ascii_value():
+    import urllib
+    from quickbooks.api import QuickbooksApi
+    from quickbooks.models import QuickbooksToken
+
+    api = QuickbooksApi(QuickbooksToken(access_token='token', access_token_secret='secret', realm_id='1',
+                                        data_source='QBO'))
+    body = {'QueryResponse': {'Customer': [{'Id': '1', 'DisplayName': u'Caf\xe9'}]}}
+    api.session = FakeSession([FakeResponse(200, body)])
+    assert [customer['Id'] for customer in api.objects('Customer').filter(DisplayName=u'Caf\xe9')] == ['1']
+    assert urllib.quote(u"DisplayName = 'Caf\xe9' STARTPOSITION".encode('utf-8')) in api.session.urls[0]
+
+    api.session = FakeSession([FakeResponse(200, body)])
+    query = "select * from Customer where DisplayName = 'Caf\xc3\xa9'"
+    assert [customer['Id'] for customer in api.query_iter(query, stream=True)] == ['1']
@@ -0,0 +1,115 @@
+"""
+Client-side throttling for the v3 api.
+
+Intuit limits each realm to a number of requests per minute and a number of
+concurrent requests, and answers with a throttle fault (HTTP 429) once either is
+exceeded. RealmThrottle enforces both limits locally, so we slow down before Intuit
+starts rejecting calls, and lets the transport push every caller for a realm back
+when a throttle fault arrives anyway.
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+DEFAULT_REQUESTS_PER_MINUTE = 500
+
+# Intuit allows 10 concurrent requests per realm.
+DEFAULT_REALM_CONCURRENCY = 10
+
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_MAX = 30.0
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """ Hands out tokens at `rate` per second, allowing bursts of up to `capacity`. """
+    def __init__(self, rate, capacity, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Takes one token, blocking until one is available. Returns the seconds spent waiting. """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self.clock()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return waited
+                    delay = (1 - self._tokens) / self.rate
+            self.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """ Hands out no tokens for the next `seconds`. """
+        with self._lock:
+            now = self.clock()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0
+            self._updated = now + seconds
+
+
+class RealmThrottle(object):
+    """ Per-minute rate limit plus a cap on concurrent requests for one realm. """
+    def __init__(self, requests_per_minute, max_concurrent):
+        self.bucket = TokenBucket(requests_per_minute / 60.0, max_concurrent)
+        self.semaphore = threading.BoundedSemaphore(max_concurrent)
+
+    @contextmanager
+    def slot(self):
+        """ Holds one request slot for the duration of the block. Yields the seconds spent
+            waiting for it.
+        """
+        started = time.time()
+        self.bucket.acquire()
+        self.semaphore.acquire()
+        try:
+            yield time.time() - started
+        finally:
+            self.semaphore.release()
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+
+def get_realm_throttle(realm_id):
+    """ Returns the throttle shared by every client of `realm_id` in this process. Limits come
+        from QUICKBOOKS['REQUESTS_PER_MINUTE'] and QUICKBOOKS['REALM_CONCURRENCY'].
+    """
+    with _throttles_lock:
+        throttle = _throttles.get(realm_id)
+        if throttle is None:
+            options = settings.QUICKBOOKS
+            throttle = _throttles[realm_id] = RealmThrottle(
+                options.get('REQUESTS_PER_MINUTE', DEFAULT_REQUESTS_PER_MINUTE),
+                options.get('REALM_CONCURRENCY', DEFAULT_REALM_CONCURRENCY))
+        return throttle
+
+
+def backoff_delay(attempt, retry_after=None):
+    """ Seconds to wait before retry number `attempt` (starting at 0): exponential backoff with
+        full jitter, or the server's Retry-After if it asked for longer.
+    """
+    options = settings.QUICKBOOKS
+    base = options.get('BACKOFF_BASE', DEFAULT_BACKOFF_BASE)
+    cap = options.get('BACKOFF_MAX', DEFAULT_BACKOFF_MAX)
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
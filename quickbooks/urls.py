@@ -5,4 +5,5 @@ urlpatterns = patterns('quickbooks.views',
                        (r'^get_access_token/?$', 'get_access_token'),
                        (r'^blue_dot_menu/?$', 'blue_dot_menu'),
                        (r'^disconnect/?$', 'disconnect'),
+                       (r'^webhook/?$', 'webhook'),
                        )
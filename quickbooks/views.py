@@ -1,27 +1,27 @@
+import json
 import logging
 
 from requests_oauthlib import OAuth1Session
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseRedirect
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render_to_response
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from .models import QuickbooksToken, get_quickbooks_token
-from .api import QuickbooksApi, AuthenticationFailure
+from .api import QuickbooksApi, AuthenticationFailure, QuickbooksError
+from .cache import app_menu_cache
+from .health import mark_token_dead
 from .signals import qb_connected
+from . import webhooks
 
 REQUEST_TOKEN_URL = 'https://oauth.intuit.com/oauth/v1/get_request_token'
 ACCESS_TOKEN_URL = 'https://oauth.intuit.com/oauth/v1/get_access_token'
 AUTHORIZATION_URL = 'https://appcenter.intuit.com/Connect/Begin'
 
-BLUE_DOT_CACHE_KEY = 'quickbooks:blue_dot_menu'
-
 
 @login_required
 def request_oauth_token(request):
-    # We'll require a refresh in the blue dot cache
-    if BLUE_DOT_CACHE_KEY in request.session:
-        del request.session[BLUE_DOT_CACHE_KEY]
-
     access_token_callback = settings.QUICKBOOKS['OAUTH_CALLBACK_URL']
     if callable(access_token_callback):
         access_token_callback = access_token_callback(request)
@@ -67,24 +67,21 @@ def get_access_token(request):
     # Delete any existing access tokens
     request.user.quickbookstoken_set.all().delete()
 
-    token = QuickbooksToken.objects.create(
+    token = QuickbooksToken(
         user=request.user,
         access_token=response['oauth_token'],
         access_token_secret=response['oauth_token_secret'],
         realm_id=realm_id,
         data_source=data_source)
-
-    # Cache blue dot menu
-    try:
-        request.session[BLUE_DOT_CACHE_KEY] = None
-        blue_dot_menu(request)
-    except AttributeError:
-        raise Exception('The sessions framework must be installed for this ' +
-                        'application to work.')
+    token.set_issued()
+    token.save()
 
     # Let everyone else know we conneted
     qb_connected.send(None, token=token)
 
+    # Cache blue dot menu
+    app_menu_cache.refresh(token)
+
     return render_to_response('oauth_callback.html',
                               {'complete_url': settings.QUICKBOOKS['ACCESS_COMPLETE_URL']})
 
@@ -93,12 +90,7 @@ def get_access_token(request):
 def blue_dot_menu(request):
     """ Returns the blue dot menu. If possible a cached copy is returned.
     """
-
-    html = request.session.get(BLUE_DOT_CACHE_KEY)
-    if not html:
-        html = request.session[BLUE_DOT_CACHE_KEY] = \
-            HttpResponse(QuickbooksApi(request.user).app_menu())
-    return html
+    return HttpResponse(app_menu_cache.get(get_quickbooks_token(request)))
 
 
 @login_required
@@ -108,10 +100,29 @@ def disconnect(request):
     token = get_quickbooks_token(request)
     try:
         QuickbooksApi(token).disconnect()
-    except AuthenticationFailure:
-        # If there is an authentication error, then these tokens are bad
-        # We need to destroy them in any case.
-        pass
+    except QuickbooksError as e:
+        # Whatever went wrong, we need to destroy the tokens in any case.
+        # If it was an authentication error, then these tokens are bad; say so.
+        logging.getLogger('quickbooks.views.disconnect').warning(
+            "Couldn't disconnect realm %s from Intuit: %s", token.realm_id, e)
+        if isinstance(e, AuthenticationFailure):
+            mark_token_dead(token, str(e))
 
     request.user.quickbookstoken_set.all().delete()
     return HttpResponseRedirect(settings.QUICKBOOKS['ACCESS_COMPLETE_URL'])
+
+
+@csrf_exempt
+@require_POST
+def webhook(request):
+    """ Receives Intuit webhook notifications. The work is queued (see quickbooks.webhooks)
+        so Intuit gets its acknowledgement right away.
+    """
+    if not webhooks.verify_signature(request.body, request.META.get('HTTP_INTUIT_SIGNATURE')):
+        return HttpResponseForbidden()
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest()
+    webhooks.dispatch(payload)
+    return HttpResponse()
@@ -0,0 +1,132 @@
+"""
+Handling of Intuit webhook notifications.
+
+The webhook view verifies the notification's signature, splits it into one event
+per changed entity, drops events it has already seen, and hands the rest to the
+queue named by QUICKBOOKS['WEBHOOK_QUEUE'] so it can answer Intuit straight away.
+The queue eventually calls process_events, which sends qb_entity_changed once for
+every active token connected to the event's realm.
+
+The default ThreadQueue processes events on a background thread in the web process.
+Any class with a put(events) method that ends up calling process_events(events)
+can be used instead, e.g. one that hands the (JSON-serializable) events to a task
+queue.
+"""
+import base64
+import hashlib
+import hmac
+import importlib
+import logging
+import threading
+from Queue import Queue
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import connection
+from django.utils.crypto import constant_time_compare
+from .models import QuickbooksToken
+from .signals import qb_entity_changed
+
+DEFAULT_WEBHOOK_QUEUE = 'quickbooks.webhooks.ThreadQueue'
+
+# Intuit may deliver a notification more than once; repeats within this window are dropped.
+DEFAULT_WEBHOOK_DEDUP_TTL = 60 * 60
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def verify_signature(body, signature):
+    """ Checks the intuit-signature header: base64(HMAC-SHA256(verifier token, body)). Nothing
+        verifies without QUICKBOOKS['WEBHOOK_VERIFIER_TOKEN'].
+    """
+    verifier_token = settings.QUICKBOOKS.get('WEBHOOK_VERIFIER_TOKEN')
+    if not signature or not verifier_token:
+        return False
+    expected = base64.b64encode(hmac.new(verifier_token.encode('utf-8'), body, hashlib.sha256).digest())
+    return constant_time_compare(expected, signature)
+
+
+def notification_events(payload):
+    """ Flattens a notification payload into one dict per changed entity. """
+    events = []
+    for notification in payload.get('eventNotifications', []):
+        realm_id = notification.get('realmId')
+        for entity in notification.get('dataChangeEvent', {}).get('entities', []):
+            events.append({'realm_id': realm_id,
+                           'entity_type': entity.get('name'),
+                           'entity_id': entity.get('id'),
+                           'operation': entity.get('operation'),
+                           'last_updated': entity.get('lastUpdated')})
+    return events
+
+
+def dispatch(payload):
+    """ Queues the events in `payload` that have not been seen before. """
+    options = settings.QUICKBOOKS
+    cache = get_cache(options.get('CACHE_ALIAS', 'default'))
+    ttl = options.get('WEBHOOK_DEDUP_TTL', DEFAULT_WEBHOOK_DEDUP_TTL)
+
+    events = []
+    for event in notification_events(payload):
+        identity = '|'.join(u'{}'.format(event[key]) for key in
+                            ('realm_id', 'entity_type', 'entity_id', 'operation', 'last_updated'))
+        key = 'quickbooks:webhook:' + hashlib.md5(identity.encode('utf-8')).hexdigest()
+        if cache.add(key, True, ttl):
+            events.append(event)
+    if events:
+        get_queue().put(events)
+    return events
+
+
+def process_events(events):
+    """ Sends qb_entity_changed for each event, once per active token connected to its realm. """
+    tokens = {}
+    realm_ids = set(event['realm_id'] for event in events)
+    for token in QuickbooksToken.objects.filter(realm_id__in=realm_ids, is_active=True):
+        tokens.setdefault(token.realm_id, []).append(token)
+
+    for event in events:
+        for token in tokens.get(event['realm_id'], []):
+            qb_entity_changed.send(sender=None, token=token, entity_type=event['entity_type'],
+                                   entity_id=event['entity_id'], operation=event['operation'],
+                                   last_updated=event['last_updated'])
+
+
+def get_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            path = settings.QUICKBOOKS.get('WEBHOOK_QUEUE', DEFAULT_WEBHOOK_QUEUE)
+            module_name, class_name = path.rsplit('.', 1)
+            _queue = getattr(importlib.import_module(module_name), class_name)()
+        return _queue
+
+
+class SynchronousQueue(object):
+    """ Processes events right away, in the request. Mostly useful for tests. """
+    def put(self, events):
+        process_events(events)
+
+
+class ThreadQueue(object):
+    """ Processes events on a daemon thread in this process. """
+    def __init__(self):
+        self._events = Queue()
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def put(self, events):
+        self._events.put(events)
+
+    def _run(self):
+        while True:
+            events = self._events.get()
+            try:
+                process_events(events)
+            except Exception:
+                logging.getLogger('quickbooks.webhooks').exception("Couldn't process webhook events %r", events)
+            finally:
+                # Don't hold this thread's database connection open between notifications.
+                connection.close()
@@ -0,0 +1,218 @@
+"""
+Coalesced, idempotent writes.
+
+A WriteQueue collects the creates and sparse updates an app makes against one
+realm and sends them when flushed:
+
+    with WriteQueue(api) as writes:
+        writes.update('Customer', '42', {'PrimaryPhone': {'FreeFormNumber': '555-0100'}})
+        writes.update('Customer', '42', {'Notes': 'Called back'})
+        writes.create('Invoice', invoice_body, key='order-1234')
+
+Updates to the same entity are merged into one sparse update (later values win)
+and sent through the batch endpoint with the entity's current SyncToken. Updates
+that hit a stale SyncToken are re-read and retried.
+
+Creates carry an idempotency key. A create whose key is already queued or was
+sent by this queue is dropped. Each create is sent on its own, with a requestid
+derived from its type and key, so Intuit won't apply it twice however often it is
+retried: after a lost response, from a later flush, or from another process.
+"""
+import hashlib
+import json
+import threading
+import uuid
+from collections import namedtuple, OrderedDict
+
+from .api import MAX_BATCH_SIZE, STALE_OBJECT_FAULT_CODES, ApiError, fault_error
+from .entities import Entity
+
+DEFAULT_MAX_CONFLICT_RETRIES = 3
+
+# Ids per SyncToken lookup query, which travels in the URL.
+SYNC_TOKEN_LOOKUP_SIZE = 100
+
+# How many sent create keys a queue remembers for deduplication.
+DEFAULT_CREATE_KEY_MEMORY = 10000
+
+
+class WriteResult(namedtuple('WriteResult', 'operation object_type key entity fault')):
+    """ The outcome of one queued write. `key` is the idempotency key of a create or the
+        Id of an updated entity.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.fault is None
+
+    @property
+    def error(self):
+        """ The QuickbooksError matching `fault`, e.g. DuplicateItemError, or None. """
+        return fault_error(self.fault) if self.fault is not None else None
+
+
+class WriteQueue(object):
+    def __init__(self, api, batch_size=MAX_BATCH_SIZE, max_conflict_retries=DEFAULT_MAX_CONFLICT_RETRIES):
+        self.api = api
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.max_conflict_retries = max_conflict_retries
+        self._creates = OrderedDict()
+        self._updates = OrderedDict()
+        self._sent_keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._creates) + len(self._updates)
+
+    def create(self, object_type, object_body, key=None):
+        """ Queues a create and returns its idempotency key (a random one if none is given).
+            Returns None if a create with the same key is already queued or was sent.
+        """
+        key = key or uuid.uuid4().hex
+        with self._lock:
+            if (object_type, key) in self._creates or (object_type, key) in self._sent_keys:
+                return None
+            self._creates[(object_type, key)] = _as_dict(object_body)
+        return key
+
+    def update(self, object_type, entity_id, changes):
+        """ Queues a sparse update of entity `entity_id`, merged with any already queued for it.
+            A SyncToken in `changes` is used as is; otherwise the current one is read at flush.
+        """
+        changes = _as_dict(changes)
+        changes.pop('Id', None)
+        changes.pop('sparse', None)
+        with self._lock:
+            self._updates.setdefault((object_type, str(entity_id)), {}).update(changes)
+
+    def flush(self):
+        """ Sends everything queued and returns a WriteResult per create and per updated entity.
+            If a request fails outright, whatever wasn't sent is queued again before the error
+            is raised.
+        """
+        with self._flush_lock:
+            with self._lock:
+                creates, self._creates = self._creates, OrderedDict()
+                updates, self._updates = self._updates, OrderedDict()
+            try:
+                return self._send_creates(creates) + self._send_updates(updates)
+            except Exception:
+                self._requeue(creates, updates)
+                raise
+
+    def _send_creates(self, creates):
+        # Not batched: a batch's requestid covers the whole batch, and only a requestid that
+        # depends on nothing but the create itself survives regrouping, requeueing and restarts.
+        results = []
+        for (object_type, key), body in list(creates.items()):
+            try:
+                response = self.api.create(object_type, body, request_id=_request_id(['create', object_type, key]))
+            except ApiError as e:
+                # Rejected by Intuit, so there is nothing to retry.
+                result = WriteResult('create', object_type, key, None, e.fault or {'Error': [{'Message': str(e)}]})
+            else:
+                self._remember_key(object_type, key)
+                result = WriteResult('create', object_type, key, response.get(object_type), None)
+            del creates[(object_type, key)]
+            results.append(result)
+        return results
+
+    def _send_updates(self, updates):
+        results = {}
+        order = list(updates)
+        pending = list(order)
+        for attempt in range(self.max_conflict_retries + 1):
+            missing = [identity for identity in pending if attempt or 'SyncToken' not in updates[identity]]
+            for identity, fault in self._read_sync_tokens(missing, updates).items():
+                pending.remove(identity)
+                del updates[identity]
+                results[identity] = WriteResult('update', identity[0], identity[1], None, fault)
+
+            conflicts = []
+            for chunk in _chunks(pending, self.batch_size):
+                operations = [('update', object_type, dict(updates[(object_type, entity_id)], Id=entity_id,
+                                                           sparse=True))
+                              for object_type, entity_id in chunk]
+                for identity, result in zip(chunk, self.api.batch(operations, request_id=_request_id(operations))):
+                    if _is_stale(result.fault) and attempt < self.max_conflict_retries:
+                        conflicts.append(identity)
+                        continue
+                    del updates[identity]
+                    results[identity] = WriteResult('update', identity[0], identity[1], result.entity, result.fault)
+            pending = conflicts
+            if not pending:
+                break
+        return [results[identity] for identity in order]
+
+    def _read_sync_tokens(self, identities, updates):
+        """ Stores the current SyncToken of each entity in its queued update, and returns a
+            fault for each entity that couldn't be found.
+        """
+        by_type = OrderedDict()
+        for object_type, entity_id in identities:
+            by_type.setdefault(object_type, []).append(entity_id)
+
+        faults = OrderedDict()
+        for object_type, entity_ids in by_type.items():
+            sync_tokens = {}
+            for chunk in _chunks(entity_ids, SYNC_TOKEN_LOOKUP_SIZE):
+                query = self.api.objects(object_type).filter(Id__in=chunk).only('Id', 'SyncToken').compile()
+                # Streamed queries skip the cache, which could hand back the very SyncToken
+                # that just went stale.
+                for entity in self.api.query_iter(query, stream=True):
+                    sync_tokens[entity['Id']] = entity['SyncToken']
+            for entity_id in entity_ids:
+                if entity_id in sync_tokens:
+                    updates[(object_type, entity_id)]['SyncToken'] = sync_tokens[entity_id]
+                else:
+                    faults[(object_type, entity_id)] = {'type': 'ObjectNotFound', 'Error': [
+                        {'Message': "{} {} doesn't exist".format(object_type, entity_id)}]}
+        return faults
+
+    def _requeue(self, creates, updates):
+        """ Puts unsent writes back in front of anything queued since the flush began. """
+        with self._lock:
+            for identity, body in self._creates.items():
+                creates.setdefault(identity, body)
+            for identity, changes in self._updates.items():
+                # Anything queued since the flush began is newer.
+                updates.setdefault(identity, {}).update(changes)
+            self._creates, self._updates = creates, updates
+
+    def _remember_key(self, object_type, key):
+        with self._lock:
+            self._sent_keys[(object_type, key)] = True
+            if len(self._sent_keys) > DEFAULT_CREATE_KEY_MEMORY:
+                self._sent_keys.popitem(last=False)
+
+
+def _as_dict(body):
+    if isinstance(body, Entity):
+        return body.to_dict()
+    if isinstance(body, dict):
+        return dict(body)
+    return json.loads(body)
+
+
+def _chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def _request_id(parts):
+    """ A requestid that stays the same for the same writes, so Intuit can spot a resent request. """
+    return hashlib.md5(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _is_stale(fault):
+    return fault is not None and any(str(error.get('code', '')) in STALE_OBJECT_FAULT_CODES
+                                     for error in fault.get('Error', []))
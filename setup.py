@@ -9,7 +9,7 @@ setup(
 
     packages = find_packages(),
 
-    install_requires = ['requests', 'requests-oauthlib', 'python-keyczar==0.71c', 'django-extensions'],
+    install_requires = ['requests', 'requests-oauthlib', 'python-keyczar==0.71c', 'django-extensions', 'futures'],
     include_package_data = True,
 
     # metadata for upload to PyPI